@@ -0,0 +1,1397 @@
+#!/usr/bin/python3
+#
+# Benchmarks for the PoCs.
+#
+# Usage: bench.py <benchmark> [size...] [options]
+#
+# Run with --help to list the available benchmarks and options.
+
+
+import gc
+import os
+import sys
+import json
+import pstats
+import inspect
+import platform
+import argparse
+import cProfile
+import subprocess
+import random
+import tempfile
+import threading
+import importlib.util
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from functools import partial
+from os import path
+from time import perf_counter, sleep, strftime
+
+
+def load(filename):
+    """Import a PoC. Their file names are not valid module names."""
+
+    name = filename.replace('-', '_')[:-3]
+    filepath = path.join(path.dirname(path.abspath(__file__)), filename)
+    spec = importlib.util.spec_from_file_location(name, filepath)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module # Picklable for the worker processes.
+    spec.loader.exec_module(module)
+    return module
+
+
+def timed(func, *args):
+    """Return (result, seconds)."""
+
+    start = perf_counter()
+    result = func(*args)
+    return result, perf_counter() - start
+
+
+def report(name, size, seconds):
+    rate = size / seconds if seconds > 0 else float('inf')
+    print("%-34s %9i msgs %10.3fs %14.0f msgs/s"% (name, size, seconds, rate))
+
+
+#
+# poc-07: StateController.getChanges
+#
+
+def legacyGetChanges07(poc, controller):
+    """The getChanges() of poc-07 before the UID index, on plain lists."""
+
+    changedMessages = []
+    messages = list(controller.driver.search())
+    stateMessages = list(controller.state.search())
+
+    for message in controller.theirState.search():
+        if message not in stateMessages:
+            stateMessages.append(deepcopy(message))
+
+    for message in messages:
+        if message not in stateMessages:
+            changedMessages.append(deepcopy(message))
+        else:
+            for stateMessage in stateMessages:
+                if message.uid == stateMessage.uid:
+                    if not message.identical(stateMessage):
+                        changedMessages.append(deepcopy(message))
+                        break
+
+    for stateMessage in stateMessages:
+        if stateMessage not in messages:
+            changedMessages.append(deepcopy(message))
+
+    return changedMessages
+
+
+def fillPoc07(poc, size, split=False):
+    """Return a state controller where 1% of the messages changed.
+
+    split: half of the messages are only known to their state."""
+
+    driverMessages = []
+    stateMessages = []
+    theirStateMessages = []
+    for uid in range(size):
+        message = poc.Message(uid, "%i body"% uid)
+        if split and uid % 2:
+            theirStateMessages.append(message)
+        else:
+            stateMessages.append(message)
+        if uid % 100 == 0:
+            message = poc.Message(uid, "%i body"% uid)
+            message.markRead()
+        driverMessages.append(message)
+    return poc.StateController(
+        poc.Driver(driverMessages),
+        poc.StateDriver(stateMessages),
+        poc.StateDriver(theirStateMessages),
+        )
+
+
+def benchGetChanges07(sizes, legacyMax=10000):
+    """poc-07 getChanges(): nested scans vs lockstep walk."""
+
+    poc = load('poc-07.py')
+    for size in sizes:
+        controller = fillPoc07(poc, size)
+        indexed, seconds = timed(controller.getChanges)
+        report("getChanges lockstep", size, seconds)
+        split = fillPoc07(poc, size, split=True)
+        for run in ("1st", "2nd"):
+            changes, seconds = timed(split.getChanges)
+            report("getChanges split states %s"% run, size, seconds)
+            assert [m.uid for m in changes] == [m.uid for m in indexed]
+        if size > legacyMax:
+            print("%-34s %9i msgs    skipped (quadratic)"%
+                ("getChanges legacy", size))
+            continue
+        controller = fillPoc07(poc, size)
+        legacy, seconds = timed(legacyGetChanges07, poc, controller)
+        report("getChanges legacy", size, seconds)
+        assert [m.uid for m in legacy] == [m.uid for m in indexed]
+
+
+def benchReconcile07(sizes, changeRate=0.01, newRate=0.01, seed=0):
+    """poc-07 first sync of both non-empty sides: uploads vs content pairing.
+
+    A newRate of the messages of left have no UID yet, like new messages in
+    a Maildir. Both sides hold a message without body, never paired."""
+
+    poc = load('poc-07.py')
+    for size in sizes:
+        for reconcile in (False, True):
+            rand = random.Random(seed)
+            sides = ([], [])
+            withoutUID = 0
+            for uid in range(size):
+                for messages in sides:
+                    message = poc.Message(uid, "%i body"% uid)
+                    if rand.random() < changeRate:
+                        message.markRead()
+                    messages.append(message)
+                if rand.random() < newRate:
+                    sides[0][-1].uid = None
+                    withoutUID += 1
+            sides[0].append(poc.Message(None))
+            sides[1].append(poc.Message(size))
+            withoutUID += 1
+            engine = poc.Engine(poc.Driver(sides[0]), poc.Driver(sides[1]),
+                reconcile=reconcile)
+            start = perf_counter()
+            if reconcile:
+                engine.reconcile()
+            changes = (list(engine.left.getChanges()) +
+                list(engine.right.getChanges()))
+            seconds = perf_counter() - start
+            new = sum(1 for message in changes if message.uid is None)
+            assert new == (0 if reconcile else withoutUID)
+            assert sum(1 for message in changes if message.body is None) == 2
+            report("first sync %s"%
+                ("reconcile" if reconcile else "upload"), size, seconds)
+            print("%-34s %9i msgs %10i bytes"% ("  to transfer", len(changes),
+                sum(len(message.body or '') for message in changes)))
+
+
+#
+# poc-02: StateController.getChanges
+#
+
+def loadPoc02():
+    poc = load('poc-02.py')
+    poc.logLevel = poc.QUIET
+    return poc
+
+
+def fillPoc02(poc, size, changeRate=0.01, newRate=0.0, seed=0,
+        flagValues=(0, 1, 2, 3)):
+    """Return a state controller for size messages, some changed or new."""
+
+    rand = random.Random(seed)
+    driver = poc.Driver("left")
+    state = poc.StateStorage()
+    for uid in range(size):
+        message = poc.Message(uid, "%i body"% uid)
+        message.flagBits = rand.choice(flagValues)
+        if rand.random() >= newRate:
+            stateMessage = poc.Message(uid, "%i body"% uid)
+            stateMessage.flagBits = message.flagBits
+            if rand.random() < changeRate:
+                stateMessage.flagBits = rand.choice(flagValues)
+            state.data[uid] = stateMessage
+        driver.data[uid] = message
+    return poc.StateController(driver, state)
+
+
+def changesOf(messages):
+    return [(m.uid, m.unkown, m.flagBits, m.addedBits, m.removedBits)
+        for m in messages.values()]
+
+
+def checkColumnar02(poc, runs=200, pool=None):
+    """Property check: the columnar path gives the same changes as the
+    per-message path on random mailboxes. With a pool, the sharded path
+    is checked too."""
+
+    for seed in range(runs):
+        rand = random.Random(seed)
+        args = (rand.randint(0, 60), rand.random(), rand.random() / 2, seed,
+            range(8))
+        expected = changesOf(fillPoc02(poc, *args).getChanges())
+        for useNumpy in (True, False):
+            for shards in ((1, 2, rand.randint(3, 9)) if pool else (1,)):
+                controller = fillPoc02(poc, *args)
+                if shards > 1:
+                    controller.pool, controller.shards = pool, shards
+                result = controller.getChangesColumnar(useNumpy=useNumpy)
+                assert changesOf(result) == expected, (seed, useNumpy,
+                    shards)
+    print("columnar path matches the per-message path (%i runs%s)"% (runs,
+        ", sharded" if pool else ""))
+
+
+def fakeRandomChanges02(poc, rand, engine, size, known, changes=10,
+        deleteRate=0.2):
+    """Change, create and delete random messages of both drivers through
+    their methods. known maps the driver names to the UIDs they ever had:
+    UIDs are never reused."""
+
+    for _ in range(rand.randint(0, changes)):
+        driver = rand.choice((engine.left.driver, engine.right.driver))
+        uid = rand.randrange(size)
+        if rand.random() < deleteRate:
+            if uid in driver.data:
+                driver.fakeDelete(uid)
+        elif uid in driver.data or uid not in known[driver.name]:
+            message = poc.Message(uid, "%i body"% uid)
+            message.flagBits = rand.randrange(4)
+            driver.fakeChange(message)
+        known[driver.name].add(uid)
+
+
+def checkModseq02(poc, runs=300, passes=4):
+    """Property check: with CONDSTORE, both drivers and the state end up
+    the same after random changes, UIDs new on both sides and failed
+    writes, once the writes succeed again."""
+
+    for seed in range(runs):
+        rand = random.Random(seed)
+        left, right = poc.ModseqDriver("left"), poc.ModseqDriver("rght")
+        retries = poc.RetryQueue(backoff=0) if seed % 2 else None
+        engine = poc.Engine(left, right, retries=retries)
+        size = rand.randint(1, 30)
+        known = {left.name: set(), right.name: set()}
+        for run in range(passes):
+            fakeRandomChanges02(poc, rand, engine, size, known)
+            for driver in (left, right):
+                driver.FakeDriverWriteError = rand.random() / 2
+                driver.faults.seed(seed * passes + run)
+            engine.run()
+            for driver in (left, right):
+                known[driver.name].update(driver.data)
+        for driver in (left, right):
+            driver.FakeDriverWriteError = False
+        for _ in range(3):
+            if retries is not None:
+                engine.retry()
+            engine.run()
+        leftContents, rightContents, stateContents = contentsOf(engine)
+        assert leftContents == rightContents == stateContents, seed
+    print("CONDSTORE drivers and state converge (%i runs)"% runs)
+
+
+def checkEngine02(poc, name, runs=200, passes=4, **options):
+    """Property check: an engine with options ends up with the same drivers,
+    state and tombstones as the plain engine after each pass of random
+    changes and deletions. Options given as ranges are drawn per run, like
+    a random batchSize."""
+
+    for seed in range(runs):
+        rand = random.Random(seed)
+        size = rand.randint(1, 40)
+        engines = []
+        for engineOptions in ({}, {key: rand.choice(value)
+                if isinstance(value, range) else value
+                for key, value in options.items()}):
+            left, right = poc.Driver("left"), poc.Driver("rght")
+            engine = poc.Engine(left, right, **engineOptions)
+            # Both engines get the same changes.
+            engines.append((engine, random.Random(seed),
+                {left.name: set(), right.name: set()}))
+        for run in range(passes):
+            results = []
+            for engine, changes, known in engines:
+                fakeRandomChanges02(poc, changes, engine, size, known)
+                engine.run()
+                for driver in (engine.left.driver, engine.right.driver):
+                    known[driver.name].update(driver.data)
+                results.append((contentsOf(engine),
+                    sorted(engine.left.state.getTombstones())))
+            assert results[0] == results[1], (name, seed, run)
+        for engine, _, _ in engines:
+            engine.close()
+    print("%s matches the plain engine (%i runs)"% (name, runs))
+
+
+def benchColumnar02(sizes):
+    """poc-02 getChanges(): per-message vs columnar flag diff."""
+
+    poc = loadPoc02()
+    checkColumnar02(poc)
+    for size in sizes:
+        controller = fillPoc02(poc, size)
+        _, seconds = timed(controller.getChanges)
+        report("getChanges per-message", size, seconds)
+        for useNumpy in (True, False):
+            if useNumpy and poc.numpy is None:
+                continue
+            name = 'numpy' if useNumpy else 'array'
+            controller = fillPoc02(poc, size)
+            _, seconds = timed(controller.getChangesColumnar, useNumpy)
+            report("getChanges columnar %s"% name, size, seconds)
+            # The diff alone, as if the storages returned columns.
+            columns = poc.FlagColumns(controller.driver.search(poc.FLAGS),
+                useNumpy=useNumpy)
+            stateColumns = poc.FlagColumns(controller.state.search(poc.FLAGS),
+                sort=True, useNumpy=useNumpy)
+            _, seconds = timed(columns.diff, stateColumns)
+            report("  diff only %s"% name, size, seconds)
+
+
+#
+# poc-02: concurrent engine.
+#
+
+def latencyDriver(poc, latency):
+    """Return a Driver class faking a network round trip per request."""
+
+    class LatencyDriver(poc.Driver):
+        requests = 0
+
+        def _fakeWrite(self):
+            self.requests += 1
+            sleep(latency)
+            return super(LatencyDriver, self)._fakeWrite()
+
+        def search(self, fields=poc.FULL):
+            self.requests += 1
+            sleep(latency)
+            return super(LatencyDriver, self).search(fields)
+
+        def fetch(self, uids, fields=poc.FULL):
+            self.requests += 1
+            sleep(latency)
+            return super(LatencyDriver, self).fetch(uids, fields)
+
+    return LatencyDriver
+
+
+def syncedEngine(poc, size, runner, driverClass, groups=1, **options):
+    """Return an engine over two synced sides of size messages where 10% of
+    the messages changed on each side, with up to groups distinct flag
+    changes per side."""
+
+    left, right = driverClass("left"), driverClass("rght")
+    engine = poc.Engine(left, right, runner=runner, **options)
+    for uid in range(size):
+        left.data[uid] = poc.Message(uid, "%i body"% uid)
+    engine.run()
+    for uid in range(0, size, 10):
+        message = poc.Message(uid, "%i body"% uid)
+        message.flagBits = 1 << (uid // 10 % 2) if groups < 2 else \
+            1 + uid // 10 % groups
+        left.fakeChange(message)
+        message = poc.Message(uid + 5, "%i body"% (uid + 5))
+        message.flagBits = 2 if groups < 2 else 1 + uid // 10 % groups
+        right.fakeChange(message)
+    return engine
+
+
+def contentsOf(engine):
+    return [sorted((uid, m.flagBits) for uid, m in storage.items())
+        for storage in (engine.left.driver.data, engine.right.driver.data,
+            engine.left.state.data)]
+
+
+def benchConcurrent02(sizes, latency=0.0005):
+    """poc-02 Engine.run(): sequential vs concurrent runners."""
+
+    poc = loadPoc02()
+    driverClass = latencyDriver(poc, latency)
+    for size in sizes:
+        expected = None
+        for name, runner in (
+                ("sequential", poc.Runner()),
+                ("threads", poc.ThreadRunner()),
+                ("asyncio", poc.AsyncioRunner()),
+                ):
+            engine = syncedEngine(poc, size, runner, driverClass)
+            _, seconds = timed(engine.run)
+            runner.close()
+            report("run %s"% name, size, seconds)
+            if expected is None:
+                expected = contentsOf(engine)
+            assert contentsOf(engine) == expected, name
+
+
+def benchBatch02(sizes, latency=0.0005):
+    """poc-02 driver writes: one request per message vs batched."""
+
+    poc = loadPoc02()
+    driverClass = latencyDriver(poc, latency)
+    for size in sizes:
+        results = []
+        for batched in (False, True):
+            engine = syncedEngine(poc, size, poc.Runner(), driverClass)
+            theirMessages = engine.right.getChanges()
+            driver = engine.left.driver
+            driver.requests = 0
+            if batched:
+                _, seconds = timed(driver.updateBatch,
+                    list(theirMessages.values()))
+            else:
+                _, seconds = timed(lambda: [driver.update(message)
+                    for message in theirMessages.values()])
+            report("writes %s (%i requests)"%
+                ('batched' if batched else 'per-message', driver.requests),
+                len(theirMessages), seconds)
+            results.append(sorted((uid, m.flagBits)
+                for uid, m in driver.data.items()))
+        assert results[0] == results[1]
+
+
+def benchWriteBehind02(sizes, latency=0.0005, stateLatency=0.005):
+    """poc-02 Engine.run(): inline vs write-behind state recording."""
+
+    poc = loadPoc02()
+
+    class SlowLeftDriver(latencyDriver(poc, latency)):
+        """Left is written last: its records come last unless ordered."""
+
+        def updateBatch(self, *args, **kw):
+            if self.name == "left":
+                sleep(stateLatency)
+            return super(SlowLeftDriver, self).updateBatch(*args, **kw)
+
+    class LatencyState(poc.StateStorage):
+        def updateBatch(self, messages):
+            sleep(stateLatency)
+            return super(LatencyState, self).updateBatch(messages)
+
+    for size in sizes:
+        expected = None
+        for writeBehind in (False, True):
+            runner = poc.ThreadRunner()
+            engine = syncedEngine(poc, size, runner, SlowLeftDriver,
+                groups=7, state=LatencyState(), writeBehind=writeBehind)
+            # New on both sides: the records of both sides do not commute.
+            for uid in range(size, size + 10):
+                for driver, flagBits in ((engine.left.driver, 1),
+                        (engine.right.driver, 2)):
+                    message = poc.Message(uid, "%i body"% uid)
+                    message.flagBits = flagBits
+                    driver.fakeChange(message)
+            _, seconds = timed(engine.run)
+            runner.close()
+            report("run %s"% ('write-behind' if writeBehind else 'inline'),
+                size, seconds)
+            if expected is None:
+                expected = contentsOf(engine)
+            assert contentsOf(engine) == expected
+
+
+def benchCopy02(sizes):
+    """poc-02 Engine.run(): deepcopy vs Message.copy() snapshots."""
+
+    poc = loadPoc02()
+    add = poc.Messages.add
+    deepcopyHook = poc.Message.__deepcopy__
+
+    def legacyAdd(self, message):
+        self.data[message.uid] = deepcopy(message)
+
+    for size in sizes:
+        for legacy in (True, False):
+            if legacy:
+                # Generic deepcopy(), as before the snapshots.
+                del poc.Message.__deepcopy__
+                poc.Messages.add = legacyAdd
+            left, right = poc.Driver("left"), poc.Driver("rght")
+            engine = poc.Engine(left, right)
+            for uid in range(size):
+                left.data[uid] = poc.Message(uid, "%i body"% uid)
+            collections = gc.get_stats()[0]['collections']
+            _, seconds = timed(engine.run)
+            collections = gc.get_stats()[0]['collections'] - collections
+
+            # Same run again, profiled.
+            for uid in range(size):
+                left.data[uid] = poc.Message(uid, "%i body"% uid)
+            right.data.clear()
+            engine.left.state.data.clear()
+            profile = cProfile.Profile()
+            profile.runcall(engine.run)
+            calls = pstats.Stats(profile).total_calls
+            # The snapshots are never shared between the drivers and the
+            # state, and the sync does not change the source messages.
+            state = engine.left.state.data
+            for uid, message in left.data.items():
+                assert message is not right.data[uid]
+                assert message is not state[uid]
+                assert message.unkown is False
+
+            poc.Message.__deepcopy__ = deepcopyHook
+            poc.Messages.add = add
+            report("run %s"% ('deepcopy' if legacy else 'snapshot'),
+                size, seconds)
+            print("%-34s %9i calls, %i gen0 GC runs"% ("", calls, collections))
+
+
+def bodyDriver(poc, bodySize):
+    """Return a Driver class loading a body of bodySize bytes each time a
+    full message is returned, like a driver reading from disk."""
+
+    class BodyDriver(poc.Driver):
+        loaded = 0
+
+        def _record(self, message, fields):
+            if fields < poc.FULL:
+                return super(BodyDriver, self)._record(message, fields)
+            self.loaded += bodySize
+            record = message.copy()
+            record.body = bytes(bodySize)
+            return record
+
+        def readBody(self, uid, chunkSize=poc.CHUNK_SIZE):
+            for offset in range(0, bodySize, chunkSize):
+                self.loaded += min(chunkSize, bodySize - offset)
+                yield bytes(min(chunkSize, bodySize - offset))
+
+    return BodyDriver
+
+
+def sinkDriver(poc):
+    """Return a Driver class writing the bodies out of memory, like a driver
+    writing to disk."""
+
+    class SinkDriver(poc.Driver):
+        received = 0
+
+        def appendStream(self, message, chunks):
+            for chunk in chunks:
+                self.received += len(chunk)
+            self.append(message)
+
+        def append(self, message):
+            if message.body is not None:
+                self.received += len(message.body)
+                message.body = None
+            super(SinkDriver, self).append(message)
+
+    return SinkDriver
+
+
+def benchSearch02(sizes, bodySize=4096):
+    """poc-02 getChanges(): full messages vs flags only from search()."""
+
+    poc = loadPoc02()
+    driverClass = bodyDriver(poc, bodySize)
+    for size in sizes:
+        for fields in (poc.FULL, poc.FLAGS):
+            name = 'full' if fields == poc.FULL else 'flags'
+            left, right = driverClass("left"), driverClass("rght")
+            engine = poc.Engine(left, right)
+            for uid in range(size):
+                left.data[uid] = poc.Message(uid)
+            engine.run()
+            for uid in range(0, size, 100):
+                message = poc.Message(uid)
+                message.markRead()
+                left.fakeChange(message)
+            left.loaded = 0
+            engine.left.fields = fields
+
+            tracemalloc.start()
+            _, seconds = timed(engine.left.getChanges)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            report("getChanges %s"% name, size, seconds)
+            print("%-34s %9i bytes loaded, %i bytes peak"%
+                ("", left.loaded, peak))
+
+
+def benchStream02(sizes, bodySize=1024 * 1024, budget=4 * 64 * 1024):
+    """poc-02 first sync of large messages: fetched vs streamed bodies."""
+
+    poc = loadPoc02()
+    for size in sizes:
+        for streamBudget in (None, budget):
+            name = 'fetched' if streamBudget is None else 'streamed'
+            left, right = bodyDriver(poc, bodySize)("left"), \
+                sinkDriver(poc)("rght")
+            for uid in range(size):
+                left.data[uid] = poc.Message(uid)
+            engine = poc.Engine(left, right, streamBudget=streamBudget)
+
+            tracemalloc.start()
+            _, seconds = timed(engine.run)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert right.received == left.loaded == size * bodySize
+            report("first sync %s"% name, size, seconds)
+            print("%-34s %9i bytes moved, %i bytes peak"%
+                ("", right.received, peak))
+
+
+def benchStreamShared02(sizes, bodySize=64 * 1024, budget=1024,
+        timeout=60.0):
+    """poc-02 streaming both ways with one connection to a shared host."""
+
+    poc = loadPoc02()
+    for size in sizes:
+        server = poc.FakeServer("imap")
+        pool = poc.ConnectionPool(maxPerHost=1)
+        left, right = poc.Driver("left"), poc.Driver("rght")
+        for driver in (left, right):
+            driver.pool, driver.server = pool, server
+        for uid in range(size):
+            (left, right)[uid % 2].fakeChange(poc.Message(uid, "x" * bodySize))
+        engine = poc.Engine(left, right, runner=poc.ThreadRunner(),
+            streamBudget=budget)
+
+        # The streams of both sides wait for each other on a deadlock.
+        worker = threading.Thread(target=engine.run, daemon=True)
+        start = perf_counter()
+        worker.start()
+        worker.join(timeout)
+        if worker.is_alive():
+            # The deadlocked threads of the runner would never be joined.
+            print("deadlock: no progress after %is"% timeout)
+            sys.stdout.flush()
+            os._exit(1)
+        report("streamed both ways", size, perf_counter() - start)
+        engine.close()
+        pool.close()
+        for driver in (left, right):
+            assert sorted(driver.data) == list(range(size))
+            assert all(len(message.body) == bodySize
+                for message in driver.data.values())
+
+
+def benchStreamExpunge02(sizes, expungeRate=0.01, bodySize=4 * 1024,
+        budget=1024, seed=0):
+    """poc-02 streaming while source messages are expunged: full run vs
+    retry queue to recover."""
+
+    poc = loadPoc02()
+
+    class ExpungingDriver(poc.Driver):
+        """Expunge the doomed messages while their body is read."""
+
+        def __init__(self, *args, **kw):
+            self.doomed = {} # UID -> chunks read before the expunge.
+            super(ExpungingDriver, self).__init__(*args, **kw)
+
+        def readBody(self, uid, chunkSize=poc.CHUNK_SIZE):
+            expungeAfter = self.doomed.pop(uid, None)
+            if expungeAfter == 0:
+                self.fakeDelete(uid)
+            chunks = super(ExpungingDriver, self).readBody(uid, chunkSize)
+            for read, chunk in enumerate(chunks, 1):
+                yield chunk
+                if read == expungeAfter:
+                    self.fakeDelete(uid)
+
+    for size in sizes:
+        doomed = random.Random(seed).sample(range(size),
+            max(2, int(size * expungeRate)))
+        for retries in (None, poc.RetryQueue(backoff=0)):
+            left, right = ExpungingDriver("left"), poc.Driver("rght")
+            for uid in range(size):
+                left.fakeChange(poc.Message(uid, b"x" * bodySize))
+            # Before the body is read, or after its first chunk.
+            left.doomed = {uid: i % 2 for i, uid in enumerate(doomed)}
+            engine = poc.Engine(left, right, streamBudget=budget,
+                retries=retries)
+            state = engine.left.state
+            failed = engine.run()['counters']['driver.rght.failed']
+            assert failed == len(doomed)
+            assert not set(doomed) & set(right.data)
+            assert not set(doomed) & set(state.data)
+            assert engine.left.budget.inFlight == 0
+
+            recover = engine.run if retries is None else engine.retry
+            metrics, seconds = timed(recover)
+            assert metrics['counters'].get('driver.rght.failed', 0) == 0
+            assert sorted(right.data) == sorted(left.data) == \
+                sorted(state.data)
+            if retries is not None:
+                assert len(retries) == 0
+            report("recover %s (%i expunged)"% ('full run'
+                if retries is None else 'retry', failed), size, seconds)
+
+
+def benchDeletion02(sizes, deleteRate=0.01, seed=0):
+    """poc-02 Engine.run() with deletions: scan, columnar and CONDSTORE."""
+
+    poc = loadPoc02()
+    for size in sizes:
+        deleted = random.Random(seed).sample(range(size),
+            int(size * deleteRate))
+        for mode in ('scan', 'columnar', 'condstore'):
+            driverClass = poc.ModseqDriver if mode == 'condstore' else \
+                poc.Driver
+            left, right = driverClass("left"), driverClass("rght")
+            engine = poc.Engine(left, right, columnar=(mode == 'columnar'))
+            state = engine.left.state
+            for uid in range(size):
+                # No flag is changed: the sides may share the messages.
+                message = poc.Message(uid)
+                if mode == 'condstore':
+                    left.fakeChange(message)
+                    right.fakeChange(message)
+                else:
+                    left.data[uid] = right.data[uid] = message
+                state.data[uid] = message
+            for driver in (left, right):
+                if mode == 'condstore':
+                    state.setSyncedModseq(driver.name, driver.highestModseq())
+            for uid in deleted:
+                left.fakeDelete(uid)
+
+            metrics, seconds = timed(engine.run)
+            assert len(right) == size - len(deleted)
+            assert len(state.getTombstones()) == len(deleted)
+            report("run %s (%i deleted)"% (mode,
+                metrics['counters']['deleted.left']), size, seconds)
+            metrics, seconds = timed(engine.run)
+            assert not state.getTombstones()
+            report("  next run (%i tombstones purged)"%
+                metrics['counters']['tombstones.purged'], size, seconds)
+
+
+def folderEngine(size, seed, latency):
+    """Return the engine of a synced folder of size messages where 10% of the
+    messages changed on the left. Module level to be sent to processes."""
+
+    poc = sys.modules['poc_02']
+    driverClass = latencyDriver(poc, latency)
+    left, right = driverClass("left"), driverClass("rght")
+    engine = poc.Engine(left, right)
+    state = engine.left.state
+    for uid in range(size):
+        message = poc.Message(uid, "%i body"% uid)
+        left.data[uid] = right.data[uid] = state.data[uid] = message
+    for uid in random.Random(seed).sample(range(size), size // 10):
+        message = poc.Message(uid, "%i body"% uid)
+        message.markRead()
+        left.fakeChange(message)
+    return engine
+
+
+def benchScheduler02(sizes, folders=32, accounts=4, latency=0.002):
+    """poc-02 Scheduler: one sync of many folders, sequential vs pools."""
+
+    poc = loadPoc02()
+    for size in sizes:
+        for name, workers, processes in (('sequential', 1, False),
+                ('threads', 8, False), ('processes', 4, True)):
+            scheduler = poc.Scheduler(workers, accountLimit=2,
+                processes=processes)
+            for i in range(folders):
+                scheduler.add("account%i"% (i % accounts), "folder%i"% i,
+                    partial(folderEngine, size, i, latency))
+            result = scheduler.run()
+            scheduler.close()
+            assert result['errors'] == 0
+            assert result['changes'] == folders * (size // 10)
+            print("%-34s %9i msgs %10.3fs %14.0f msgs/s"% (
+                "%s x%i (%i folders)"% (name, workers, folders),
+                size, result['seconds'], result['scannedPerSecond']))
+
+
+def pooledFolderEngine(size, seed, latency, pool, server):
+    """Same as folderEngine() with the requests of the left driver going
+    through the connection pool."""
+
+    engine = folderEngine(size, seed, latency)
+    engine.left.driver.pool = pool
+    engine.left.driver.server = server
+    return engine
+
+
+def benchPool02(sizes, folders=32, accounts=4, latency=0.001,
+        connectLatency=0.02):
+    """poc-02 Scheduler: connection per request vs connection pool."""
+
+    poc = loadPoc02()
+    for size in sizes:
+        # Without reuse, each request opens its own connection.
+        for name, pool in (
+                ('connection per request', poc.ConnectionPool(
+                    maxPerHost=folders, idleTimeout=0.0)),
+                ('pool', poc.ConnectionPool(maxPerHost=2))):
+            servers = [poc.FakeServer("imap%i"% i, connectLatency)
+                for i in range(accounts)]
+            scheduler = poc.Scheduler(8, accountLimit=2)
+            for i in range(folders):
+                scheduler.add("account%i"% (i % accounts), "folder%i"% i,
+                    partial(pooledFolderEngine, size, i, latency, pool,
+                        servers[i % accounts]))
+            result = scheduler.run()
+            scheduler.close()
+            pool.close()
+            assert result['errors'] == 0
+            metrics = pool.metrics.snapshot()
+            print("%-34s %9i msgs %10.3fs %5i connections %5.1f%% reused "
+                "%7.3fs waited"% ("%s (%i folders)"% (name, folders), size,
+                result['seconds'], sum(server.connections
+                for server in servers), 100 * pool.reuseRate(),
+                metrics['timers']['pool.wait']['seconds']))
+
+
+def benchLockstep02(sizes, changeRate=0.01, batchSize=1000, seed=0):
+    """poc-02 Engine.run(): whole changes vs lockstep batches."""
+
+    poc = loadPoc02()
+    checkEngine02(poc, "lockstep", batchSize=range(1, 11))
+    rand = random.Random(seed)
+
+    class TimedDriver(poc.Driver):
+        firstWrite = None
+
+        def _fakeWrite(self):
+            if self.firstWrite is None:
+                self.firstWrite = perf_counter()
+            return super(TimedDriver, self)._fakeWrite()
+
+    def changedEngine(size, uids, mode):
+        left, right = TimedDriver("left"), TimedDriver("rght")
+        engine = poc.Engine(left, right, batchSize=mode)
+        for uid in range(size):
+            left.fakeChange(poc.Message(uid, "%i body"% uid))
+        engine.run()
+        for uid in uids:
+            message = poc.Message(uid, "%i body"% uid)
+            message.markRead()
+            right.fakeChange(message)
+        left.firstWrite = None
+        return engine, left
+
+    for size in sizes:
+        uids = rand.sample(range(size), int(size * changeRate))
+        for mode in (None, batchSize):
+            engine, left = changedEngine(size, uids, mode)
+            start = perf_counter()
+            engine.run()
+            seconds = perf_counter() - start
+            firstWrite = left.firstWrite - start
+
+            # Same pass again to measure the memory: tracemalloc is slow.
+            engine, left = changedEngine(size, uids, mode)
+            tracemalloc.start()
+            engine.run()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("%-34s %9i msgs %10.3fs %8.1f MiB peak %7.3fs to 1st "
+                "write"% ("run %s"% ('whole' if mode is None else
+                'lockstep by %i'% mode), size, seconds, peak / 2**20,
+                firstWrite))
+
+
+def benchPipeline02(sizes, changeRate=0.1, batchSize=100, queueSize=2,
+        latency=0.0002, seed=0):
+    """poc-02 Engine.run() to a slow driver: inline vs worker batches."""
+
+    poc = loadPoc02()
+    checkEngine02(poc, "worker pipeline", batchSize=range(1, 11),
+        queueSize=range(1, 4))
+    rand = random.Random(seed)
+
+    class SlowDriver(poc.Driver):
+        latency = 0.0
+
+        def _fakeWrite(self):
+            sleep(self.latency) # Would wait for the server.
+            return super(SlowDriver, self)._fakeWrite()
+
+    def changedEngine(size, uids, batchSize, queueSize):
+        """The new messages of left are spread over the UIDs."""
+
+        left, right = poc.Driver("left"), SlowDriver("rght")
+        engine = poc.Engine(left, right, batchSize=batchSize,
+            queueSize=queueSize)
+        for uid in range(size):
+            if uid not in uids:
+                left.fakeChange(poc.Message(uid, "%i body"% uid))
+        engine.run()
+        for uid in uids:
+            left.fakeChange(poc.Message(uid, "%i body"% uid))
+        right.latency = latency
+        return engine
+
+    for size in sizes:
+        uids = set(rand.sample(range(size), int(size * changeRate)))
+        expected = None
+        for mode in ((None, None), (batchSize, None), (batchSize, queueSize)):
+            engine = changedEngine(size, uids, *mode)
+            start = perf_counter()
+            metrics = engine.run()
+            seconds = perf_counter() - start
+            # Same drivers and state as the whole pass.
+            if expected is None:
+                expected = contentsOf(engine)
+            assert contentsOf(engine) == expected, mode
+
+            # Same pass again to measure the memory: tracemalloc is slow.
+            engine = changedEngine(size, uids, *mode)
+            tracemalloc.start()
+            engine.run()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            name = "run whole"
+            if mode[1] is not None:
+                name = "run workers, queues of %i"% mode[1]
+            elif mode[0] is not None:
+                name = "run lockstep by %i"% mode[0]
+            print("%-34s %9i msgs %10.3fs %8.1f MiB peak"% (name, size,
+                seconds, peak / 2**20))
+            for worker in ("merge", "left", "right", "state"):
+                busy = metrics['timers'].get("worker.%s.busy"% worker)
+                if busy is None:
+                    continue
+                blocked = metrics['timers'].get("worker.%s.blocked"% worker,
+                    {'seconds': 0.0})
+                print("  %-32s busy %7.3fs, senders blocked %7.3fs, "
+                    "queue peak %i"% (worker, busy['seconds'],
+                    blocked['seconds'],
+                    metrics['gauges']["queue.%s"% worker]['peak']))
+
+
+def benchSharded02(sizes, shards=4):
+    """poc-02 getChanges(): columnar diff in-process vs sharded in processes."""
+
+    poc = loadPoc02()
+    pool = ProcessPoolExecutor(shards)
+    checkColumnar02(poc, runs=50, pool=pool)
+    for size in sizes:
+        for useNumpy in (True, False):
+            if useNumpy and poc.numpy is None:
+                continue
+            name = 'numpy' if useNumpy else 'array'
+            for pooled in (False, True):
+                controller = fillPoc02(poc, size)
+                if pooled:
+                    controller.pool, controller.shards = pool, shards
+                _, seconds = timed(controller.getChangesColumnar, useNumpy)
+                report("getChanges %s %s"% (name,
+                    "sharded x%i"% shards if pooled else "in-process"),
+                    size, seconds)
+                columns = poc.FlagColumns(controller.driver.search(poc.FLAGS),
+                    useNumpy=useNumpy)
+                stateColumns = poc.FlagColumns(
+                    controller.state.search(poc.FLAGS), sort=True,
+                    useNumpy=useNumpy)
+                if pooled:
+                    _, seconds = timed(columns.diffSharded, stateColumns,
+                        pool, shards)
+                else:
+                    _, seconds = timed(columns.diff, stateColumns)
+                report("  diff only", size, seconds)
+    pool.shutdown()
+
+
+def legacyMerge02(ourMessages, theirMessages):
+    """Messages.merge() of poc-02 before the merge engine: iterate over all
+    their changes and merge our messages in place."""
+
+    for uid, theirMessage in theirMessages.items():
+        if uid in ourMessages.data:
+            ourMessage = ourMessages.data[uid]
+            same = (ourMessage.addedBits & theirMessage.addedBits) | \
+                (ourMessage.removedBits & theirMessage.removedBits)
+            if same == 0:
+                continue
+            for message in (ourMessage, theirMessage):
+                message.addedBits &= ~same
+                message.removedBits &= ~same
+
+
+def changeSet(poc, uids, bit):
+    messages = poc.Messages()
+    for uid in uids:
+        message = poc.Message(uid)
+        message.flagBits = message.addedBits = bit
+        messages.data[uid] = message
+    return messages
+
+
+def benchMerge02(sizes, small=10):
+    """poc-02 merge of asymmetric change sets: legacy vs merge engine."""
+
+    poc = loadPoc02()
+    for size in sizes:
+        # The small side changed a few messages also changed in the other.
+        smallUIDs = range(0, size, size // small)
+        for smallSide in ('left', 'rght'):
+            big, little = changeSet(poc, range(size), 1), \
+                changeSet(poc, smallUIDs, 1)
+            left, right = (little, big) if smallSide == 'left' else \
+                (big, little)
+            _, seconds = timed(legacyMerge02, left, right)
+            report("legacy, %i in %s"% (small, smallSide), size, seconds)
+
+            for policy in (None, poc.newestWins):
+                left, right = changeSet(poc, smallUIDs, 1), \
+                    changeSet(poc, range(size), 1)
+                if smallSide == 'rght':
+                    left, right = right, left
+                result, seconds = timed(poc.Merge(policy).merge, left, right)
+                assert len(result[2]) == small
+                report("engine %s, %i in %s"% ('newest' if policy else
+                    'union', small, smallSide), size, seconds)
+
+
+def benchModseq02(sizes):
+    """poc-02 Engine.run() without changes: full scan vs CONDSTORE."""
+
+    poc = loadPoc02()
+    checkModseq02(poc)
+    for size in sizes:
+        for driverClass in (poc.Driver, poc.ModseqDriver):
+            left, right = driverClass("left"), driverClass("rght")
+            engine = poc.Engine(left, right)
+            for uid in range(size):
+                left.fakeChange(poc.Message(uid, "%i body"% uid))
+            engine.run()
+            metrics, seconds = timed(engine.run)
+            counters = metrics['counters']
+            report("no-change run %s (%i scanned)"% (driverClass.__name__,
+                counters['scanned.left'] + counters['scanned.rght']),
+                size, seconds)
+
+
+def benchRetry02(sizes, changeRate=0.01, failureRate=0.5, seed=0):
+    """poc-02 recovery of failed writes: full run vs retry queue."""
+
+    poc = loadPoc02()
+    rand = random.Random(seed)
+    for size in sizes:
+        changes = []
+        for uid in rand.sample(range(size), int(size * changeRate)):
+            message = poc.Message(uid, "%i body"% uid)
+            message.flagBits = rand.randrange(1, 4)
+            changes.append(message)
+        for retries in (None, poc.RetryQueue(backoff=0)):
+            left, right = poc.Driver("left"), poc.Driver("rght")
+            engine = poc.Engine(left, right, retries=retries)
+            for uid in range(size):
+                left.fakeChange(poc.Message(uid, "%i body"% uid))
+            engine.run()
+            for message in changes:
+                right.fakeChange(message)
+            left.FakeDriverWriteError = failureRate
+            left.faults.seed(seed)
+            failed = engine.run()['counters']['driver.left.failed']
+            left.FakeDriverWriteError = False
+            recover = engine.run if retries is None else engine.retry
+            metrics, seconds = timed(recover)
+            counters = metrics['counters']
+            report("recover %s (%i failed, %i scanned)"% ('full run'
+                if retries is None else 'retry', failed,
+                counters.get('scanned.left', 0) +
+                counters.get('scanned.rght', 0)), size, seconds)
+
+
+def benchDigests02(sizes, changes=(0, 10, 100, 1000), seed=0):
+    """poc-02 Engine.run(): full scan vs range digests, by changes."""
+
+    poc = loadPoc02()
+    checkEngine02(poc, "digests", digests=True)
+    rand = random.Random(seed)
+    for size in sizes:
+        for digests in (False, True):
+            left, right = poc.Driver("left"), poc.Driver("rght")
+            for uid in range(size):
+                left.fakeChange(poc.Message(uid, "%i body"% uid))
+            engine = poc.Engine(left, right, digests=digests)
+            engine.run()
+            for count in changes:
+                for uid in rand.sample(range(size), count):
+                    message = poc.Message(uid, "%i body"% uid)
+                    message.flagBits = right.data[uid].flagBits ^ 1
+                    right.fakeChange(message)
+                metrics, seconds = timed(engine.run)
+                counters = metrics['counters']
+                report("run %s, %i changes (%i scanned)"% ('digests'
+                    if digests else 'full scan', count,
+                    counters['scanned.left'] + counters['scanned.rght']),
+                    size, seconds)
+
+
+#
+# poc-02: persistent state.
+#
+
+def benchPersistent02(sizes):
+    """poc-02 PersistentStateStorage: load, update and lookup costs."""
+
+    poc = loadPoc02()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in sizes:
+            path = os.path.join(tmpdir, "state-%i"% size)
+            state = poc.PersistentStateStorage(path)
+            state.load()
+            state.records = {uid: (uid % 4, 0) for uid in range(size)}
+            state.compact()
+            state.close()
+            snapshotSize = os.path.getsize(path)
+
+            for useMmap in (False, True):
+                mode = 'mmap' if useMmap else 'dict'
+
+                def openState():
+                    state = poc.PersistentStateStorage(path, useMmap)
+                    state.view()
+                    return state
+
+                state, seconds = timed(openState)
+                report("open state (%s)"% mode, size, seconds)
+
+                def lookup(uids):
+                    records = state.view()
+                    return [records[uid].flagBits for uid in uids]
+
+                uids = random.Random(size).sample(range(size), 50)
+                _, seconds = timed(lookup, uids)
+                print("%-34s %9i msgs %10.6fs"%
+                    ("lookup 50 (%s)"% mode, size, seconds))
+
+                message = poc.Message(uids[0])
+                message.markImportant()
+                _, seconds = timed(state.update, message)
+                state.close()
+                assert os.path.getsize(path) == snapshotSize
+                print("%-34s %9i msgs %10.6fs journal: %i bytes"%
+                    ("update one (%s)"% mode, size, seconds,
+                    os.path.getsize(state.journalPath)))
+                os.remove(state.journalPath)
+
+                # Both sides load the state at once.
+                left, right = poc.Driver("left"), poc.Driver("rght")
+                for uid in range(size):
+                    for driver in (left, right):
+                        driver.data[uid] = poc.Message(uid)
+                        driver.data[uid].flagBits = uid % 4
+                runner = poc.ThreadRunner()
+                engine = poc.Engine(left, right, runner=runner,
+                    state=poc.PersistentStateStorage(path, useMmap))
+                metrics, seconds = timed(engine.run)
+                engine.close()
+                report("run threads (%s)"% mode, size, seconds)
+                assert metrics['counters']['changes.left'] == 0
+                assert metrics['counters']['changes.rght'] == 0
+
+
+#
+# Message footprint.
+#
+
+class LegacyMessage02(object):
+    """Layout of the poc-02 Message before the compact record, as stored by
+    the drivers (deep copies own their changes dicts)."""
+
+    def __init__(self, uid=None, body=None):
+        self.uid = uid
+        self.body = body
+        self.unkown = False
+        self.flags = {'read': False, 'important': False}
+        self.changes = {'read': None, 'important': None}
+        self.stateChanges = {'read': None, 'important': None}
+
+
+class LegacyMessage07(object):
+    """Layout of the poc-07 Message before the compact record."""
+
+    def __init__(self, uid=None, body=None):
+        self.uid = uid
+        self.body = body
+        self.flags = {'read': False, 'important': False}
+        self.changes = {'read': None, 'important': None, 'deleted': False}
+
+
+def footprint(cls, size):
+    """Return the traced bytes per message for size messages of cls."""
+
+    body = "shared body" # Do not account the bodies.
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = [cls(uid, body) for uid in range(size)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # Do not account the list nor the UID ints.
+    overhead = sys.getsizeof(messages) + sum(sys.getsizeof(uid)
+        for uid in range(256, size))
+    del messages
+    return (after - before - overhead) / size
+
+
+def benchMemory(sizes):
+    """Per-message footprint of the dict-based vs compact Message."""
+
+    poc02 = load('poc-02.py')
+    poc07 = load('poc-07.py')
+    for size in sizes:
+        for name, cls in (
+                ("poc-02 legacy", LegacyMessage02),
+                ("poc-02 compact", poc02.Message),
+                ("poc-07 legacy", LegacyMessage07),
+                ("poc-07 compact", poc07.Message),
+                ):
+            print("%-34s %9i msgs %10.1f bytes/msg"%
+                (name, size, footprint(cls, size)))
+
+
+#
+# poc-02: full sync pass, phase by phase.
+#
+
+def syntheticEngine(poc, size, changeRate, conflictRate, failureRate, seed):
+    """Return an engine over two synced sides of size messages.
+
+    changeRate of the messages changed on a side, conflictRate of those
+    changed on both sides. failureRate of the driver requests fail through
+    Driver.FakeDriverWriteError."""
+
+    rand = random.Random(seed)
+    left, right = poc.Driver("left"), poc.Driver("rght")
+    for driver in (left, right):
+        driver.FakeDriverWriteError = failureRate
+        driver.faults.seed(seed)
+    state = poc.StateStorage()
+    for uid in range(size):
+        flagBits = rand.randrange(4)
+        for storage in (left.data, right.data, state.data):
+            storage[uid] = poc.Message(uid, "%i body"% uid)
+            storage[uid].flagBits = flagBits
+
+    for uid in rand.sample(range(size), int(size * changeRate)):
+        sides = [rand.choice((left, right))]
+        if rand.random() < conflictRate:
+            sides = [left, right]
+        for side in sides:
+            message = poc.Message(uid, "%i body"% uid)
+            message.flagBits = rand.randrange(4)
+            side.fakeChange(message)
+    return poc.Engine(left, right, state=state)
+
+
+def timePhases(poc, engine):
+    """Run a pass of the engine and return the seconds spent per phase and
+    the counters, from the metrics of the engine."""
+
+    metrics = engine.run()
+    phases = {name: timer['seconds']
+        for name, timer in metrics['timers'].items()}
+    return phases, metrics['counters']
+
+
+def version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+            cwd=path.dirname(path.abspath(__file__)),
+            capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def benchSync02(sizes, changeRate=0.01, conflictRate=0.1, failureRate=0.0,
+        seed=0, jsonPath=None, comparePath=None):
+    """poc-02 Engine.run() phase by phase on synthetic mailboxes."""
+
+    poc = loadPoc02()
+    params = {'changeRate': changeRate, 'conflictRate': conflictRate,
+        'failureRate': failureRate, 'seed': seed}
+    results = []
+    for size in sizes:
+        args = (poc, size, changeRate, conflictRate, failureRate, seed)
+        phases, counters = timePhases(poc, syntheticEngine(*args))
+
+        # Same pass again to measure the memory: tracemalloc is slow.
+        engine = syntheticEngine(*args)
+        tracemalloc.start()
+        engine.run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        for phase in sorted(phases, key=lambda phase: phase == 'run'):
+            report(phase, size, phases[phase])
+        print("%-34s %9i msgs %10.1f MiB peak\n"%
+            ("memory", size, peak / 2**20))
+        results.append({'size': size, 'phases': phases, 'counters': counters,
+            'msgsPerSecond': size / phases['run'], 'peakBytes': peak})
+
+    output = {'benchmark': 'sync-02', 'version': version(),
+        'date': strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(), 'params': params,
+        'results': results}
+    if jsonPath is not None:
+        with open(jsonPath, 'w') as fd:
+            json.dump(output, fd, indent=2)
+    if comparePath is not None:
+        compareResults(comparePath, output)
+
+
+def compareResults(comparePath, output):
+    """Print the ratio of the phase timings against previous results."""
+
+    with open(comparePath) as fd:
+        previous = json.load(fd)
+    if previous['params'] != output['params']:
+        print("warning: parameters differ from %s"% comparePath)
+    bySize = {result['size']: result for result in previous['results']}
+    print("compared to %s (%s):"% (comparePath, previous['version']))
+    for result in output['results']:
+        old = bySize.get(result['size'])
+        if old is None:
+            continue
+        for phase, seconds in sorted(result['phases'].items()):
+            if old['phases'].get(phase):
+                print("%-34s %9i msgs %9.2fx"% (phase, result['size'],
+                    seconds / old['phases'][phase]))
+
+
+BENCHMARKS = {
+    'batch-02': (benchBatch02, [1000, 10000]),
+    'columnar-02': (benchColumnar02, [10000, 100000, 1000000]),
+    'copy-02': (benchCopy02, [100000]),
+    'deletion-02': (benchDeletion02, [100000, 1000000]),
+    'digests-02': (benchDigests02, [100000, 1000000]),
+    'concurrent-02': (benchConcurrent02, [100, 1000]),
+    'getchanges-07': (benchGetChanges07, [10000, 100000, 1000000]),
+    'lockstep-02': (benchLockstep02, [100000, 1000000]),
+    'memory': (benchMemory, [1000000]),
+    'merge-02': (benchMerge02, [100000, 1000000]),
+    'modseq-02': (benchModseq02, [10000, 100000]),
+    'writebehind-02': (benchWriteBehind02, [1000, 10000]),
+    'persistent-02': (benchPersistent02, [10000, 100000, 1000000]),
+    'pipeline-02': (benchPipeline02, [10000, 100000]),
+    'pool-02': (benchPool02, [100, 1000]),
+    'reconcile-07': (benchReconcile07, [10000, 100000]),
+    'retry-02': (benchRetry02, [100000, 1000000]),
+    'scheduler-02': (benchScheduler02, [1000, 10000]),
+    'search-02': (benchSearch02, [10000, 100000]),
+    'sharded-02': (benchSharded02, [100000, 1000000]),
+    'stream-02': (benchStream02, [100, 500]),
+    'stream-shared-02': (benchStreamShared02, [100, 1000]),
+    'stream-expunge-02': (benchStreamExpunge02, [1000, 10000]),
+    'sync-02': (benchSync02, [10000, 100000]),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="benchmarks:\n%s"% "\n".join("  %-20s %s"%
+            (name, func.__doc__) for name, (func, _)
+            in sorted(BENCHMARKS.items())))
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS),
+        metavar='benchmark')
+    parser.add_argument('sizes', type=int, nargs='*', metavar='size')
+    parser.add_argument('--change-rate', dest='changeRate', type=float)
+    parser.add_argument('--conflict-rate', dest='conflictRate', type=float)
+    parser.add_argument('--failure-rate', dest='failureRate', type=float)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--json', dest='jsonPath',
+        help="save the results to this file")
+    parser.add_argument('--compare', dest='comparePath',
+        help="compare the results to this file")
+    args = parser.parse_args()
+
+    func, sizes = BENCHMARKS[args.benchmark]
+    accepted = inspect.signature(func).parameters
+    options = {name: value for name, value in vars(args).items()
+        if name in accepted and name != 'sizes' and value is not None}
+    func(args.sizes or sizes, **options)
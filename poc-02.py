@@ -7,37 +7,317 @@
 #     This allows to mark identical changes to avoid propagating them to the
 #     driver.
 # [x] Learn the state driver to only record successful updates.
-# [ ] Learn deletions.
+# [x] Learn deletions.
 # [ ] Expose updates to the rascal.
-# [ ] Turn into concurrent mode.
-
-
-from functools import total_ordering
+# [x] Turn into concurrent mode.
+
+
+import os
+import mmap
+import queue
+import pstats
+import random
+import struct
+import asyncio
+import inspect
+import cProfile
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import UserDict
-from copy import deepcopy
+from collections.abc import Mapping
+from concurrent.futures import (FIRST_COMPLETED, Future, ProcessPoolExecutor,
+    ThreadPoolExecutor, wait)
+from contextlib import contextmanager
+from functools import partial, total_ordering
+from operator import itemgetter
+from time import perf_counter, sleep, time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEBUG = 10 # Per-message logs.
+INFO = 20
+WARNING = 30
+QUIET = 100
+
+logLevel = DEBUG
+logLock = threading.Lock() # Runners may log from several threads.
+
+def log(message, *args, level=INFO):
+    """Log the message if level is enabled. The message is only formatted
+    with args when logged. Hot paths should check logLevel first."""
+
+    if level < logLevel:
+        return
+    if args:
+        message = message % args
+    with logLock:
+        print(message)
+
+
+# Fields of the messages returned by search(), each level includes the
+# previous ones.
+UID = 0
+FLAGS = 1
+FULL = 2 # With the body.
+
+CHUNK_SIZE = 64 * 1024 # Bytes of the body per read when streaming.
+SEARCH_PAGE = 1024 # UIDs per request of Driver.searchSorted().
+
+
+class Metrics(object):
+    """Timers, counters and gauges of the engine.
+
+    Timers record the number of calls, the total and the longest duration.
+    Gauges record the last and the highest value. The timers named in profile
+    are also run under cProfile: they must not be nested nor run
+    concurrently."""
+
+    def __init__(self, profile=()):
+        self.profile = set(profile)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            _, peak = self.gauges.get(name, (value, value))
+            self.gauges[name] = (value, max(peak, value))
+
+    def profileStats(self, name):
+        """Return the pstats.Stats of a profiled timer."""
+
+        return pstats.Stats(self.profiles[name])
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.timers = {}
+            self.profiles = {}
+
+    def snapshot(self):
+        """Return the metrics as a dict of plain values."""
+
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': {name: {'value': value, 'peak': peak}
+                    for name, (value, peak) in self.gauges.items()},
+                'timers': {name: {'calls': calls, 'seconds': seconds,
+                    'max': longest} for name, (calls, seconds, longest)
+                    in self.timers.items()},
+                }
+
+    @contextmanager
+    def timer(self, name):
+        profile = None
+        if name in self.profile:
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            if profile is not None:
+                profile.disable()
+            with self.lock:
+                calls, total, longest = self.timers.get(name, (0, 0.0, 0.0))
+                self.timers[name] = (calls + 1, total + seconds,
+                    max(longest, seconds))
+
+class ByteBudget(object):
+    """Bound the bytes of the bodies in flight between the drivers.
+
+    A chunk is reserved before it is read from the source and released once
+    written to the destination. Streams running in parallel share the
+    budget."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.inFlight = 0
+        self.peak = 0 # Highest number of bytes reserved at once.
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        size = min(size, self.limit) # A chunk larger than the budget.
+        with self.condition:
+            while self.inFlight + size > self.limit:
+                self.condition.wait()
+            self.inFlight += size
+            self.peak = max(self.peak, self.inFlight)
+        return size
+
+    def release(self, size):
+        with self.condition:
+            self.inFlight -= size
+            self.condition.notify_all()
+
+    def stream(self, chunks, chunkSize=CHUNK_SIZE):
+        """Iterate over chunks within the budget. Each chunk is reserved until
+        the next one is requested.
+
+        The budget is waited for before each chunk is requested: chunks must
+        not hold a connection meanwhile, see Driver.readBody()."""
+
+        chunks = iter(chunks)
+        while True:
+            size = self.acquire(chunkSize)
+            try:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+            finally:
+                self.release(size)
+
+
+def uidRanges(uids):
+    """Compress integer UIDs into sorted (first, last) ranges, like the UID
+    sets of IMAP."""
+
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1] = (ranges[-1][0], uid)
+        else:
+            ranges.append((uid, uid))
+    return ranges
+
+
+def mergeJoin(*iterables):
+    """Walk UID-sorted iterables of messages in lockstep, like a merge join.
+
+    Yield a (uid, message, ...) tuple per UID with a message per iterable,
+    None where the UID is missing. Only the current message of each
+    iterable is held."""
+
+    end = float('inf') # UID of the exhausted iterables.
+    iterators = [iter(iterable) for iterable in iterables]
+    heads = [next(iterator, None) for iterator in iterators]
+    uids = [end if head is None else head.uid for head in heads]
+    indexes = range(len(heads))
+    while True:
+        uid = min(uids)
+        if uid == end:
+            return
+        row = [uid]
+        for i in indexes:
+            if uids[i] == uid:
+                row.append(heads[i])
+                head = heads[i] = next(iterators[i], None)
+                uids[i] = end if head is None else head.uid
+            else:
+                row.append(None)
+        yield tuple(row)
+
+
+class RangeDigests(object):
+    """Hierarchical digests of the flags of the messages by UID ranges.
+
+    The digest of a bucket of UIDs is the XOR of the hashes of the (uid,
+    flags) of its messages. Each level rolls up the digests of FANOUT nodes
+    of the level below, like a Merkle tree. With XOR, adding, removing or
+    changing a message flips one node per level: updates are incremental.
+    Two storages with the same digests have the same flags so diff() only
+    descends into the nodes which differ."""
+
+    BUCKET_BITS = 8 # 256 UIDs per bucket.
+    FANOUT_BITS = 4 # 16 children per node.
+    LEVELS = 7 # Up to 2**32 UIDs, like IMAP.
+
+    def __init__(self, messages=()):
+        buckets = {}
+        for message in messages:
+            key = message.uid >> self.BUCKET_BITS
+            buckets[key] = buckets.get(key, 0) ^ \
+                hash((message.uid, message.flagBits))
+        self.levels = [buckets]
+        for _ in range(self.LEVELS - 1):
+            nodes = {}
+            for key, digest in self.levels[-1].items():
+                key >>= self.FANOUT_BITS
+                nodes[key] = nodes.get(key, 0) ^ digest
+            self.levels.append(nodes)
+
+    def diff(self, other):
+        """Return the sorted UID ranges of the buckets whose digests differ
+        from other."""
+
+        fanout = 1 << self.FANOUT_BITS
+        top = self.levels[-1].keys() | other.levels[-1].keys()
+        keys = sorted(top)
+        for level in reversed(range(self.LEVELS)):
+            ours, theirs = self.levels[level], other.levels[level]
+            keys = [key for key in keys
+                if ours.get(key, 0) != theirs.get(key, 0)]
+            if level > 0:
+                keys = [child for key in keys
+                    for child in range(key * fanout, (key + 1) * fanout)]
+        bucket = 1 << self.BUCKET_BITS
+        return [(key * bucket, (key + 1) * bucket - 1) for key in keys]
+
+    def update(self, uid, oldFlags, newFlags):
+        """Record that the flags of uid changed from oldFlags to newFlags,
+        None when there is no message."""
+
+        delta = 0
+        if oldFlags is not None:
+            delta ^= hash((uid, oldFlags))
+        if newFlags is not None:
+            delta ^= hash((uid, newFlags))
+        if delta == 0:
+            return
+        key = uid >> self.BUCKET_BITS
+        for nodes in self.levels:
+            nodes[key] = nodes.get(key, 0) ^ delta
+            key >>= self.FANOUT_BITS
 
-def log(*whatever):
-    print(*whatever)
 
 @total_ordering
 class Message(object):
-    """Fake the real Message class."""
+    """Fake the real Message class.
+
+    Flags are stored as a bitmask (see FLAGS). Changes are tri-state and are
+    stored as two bitmasks: the flags added and the flags removed since
+    previous sync. A flag in none of them did not change."""
+
+    __slots__ = ('uid', 'body', 'unkown', 'destroyed', 'mtime', 'flagBits',
+        'addedBits', 'removedBits', 'stateAddedBits', 'stateRemovedBits')
 
-    DEFAULT_CHANGES = {'read': None, 'important': None}
+    FLAGS = {'read': 1, 'important': 2, 'deleted': 4}
+    DEFAULT_FLAGS = ('read', 'important') # Always exposed in flag dicts.
 
     def __init__(self, uid=None, body=None):
         self.uid = uid
         self.body = body
 
         self.unkown = False # This is a new message.
-        self.flags = {'read': False, 'important': False}
+        self.destroyed = False # This message was expunged.
+        self.mtime = 0.0 # Time of the last change in the driver.
+        self.flagBits = 0
         # Store what was changed since previous sync. Flags can be:
-        # - True: addition
-        # - False: deletion
-        # - None: no change
-        self.changes = self.DEFAULT_CHANGES
+        # - in addedBits: addition
+        # - in removedBits: deletion
+        # - in none: no change
+        self.addedBits = 0
+        self.removedBits = 0
         # Update the state only with those changes.
-        self.stateChanges = self.DEFAULT_CHANGES
+        self.stateAddedBits = 0
+        self.stateRemovedBits = 0
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return self.copy()
 
     def __repr__(self):
         return "<Message %s [%s] '%s'>"% (self.uid, self.flags, self.body)
@@ -51,25 +331,70 @@ class Message(object):
     def __lt__(self, other):
         return self.uid < other
 
+    @staticmethod
+    def _bitsToChanges(added, removed):
+        changes = {}
+        for flag, bit in Message.FLAGS.items():
+            if added & bit:
+                changes[flag] = True
+            elif removed & bit:
+                changes[flag] = False
+            elif flag in Message.DEFAULT_FLAGS:
+                changes[flag] = None
+        return changes
+
+    @property
+    def changes(self):
+        return self._bitsToChanges(self.addedBits, self.removedBits)
+
+    @property
+    def flags(self):
+        flags = {}
+        for flag, bit in self.FLAGS.items():
+            if flag in self.DEFAULT_FLAGS or self.flagBits & bit:
+                flags[flag] = bool(self.flagBits & bit)
+        return flags
+
+    @property
+    def stateChanges(self):
+        return self._bitsToChanges(self.stateAddedBits, self.stateRemovedBits)
+
+    def copy(self):
+        """Return a snapshot of this message.
+
+        All the fields are immutable values: the snapshot shares them, the
+        body included, and only the slots are copied. This is enough for the
+        collections to share records: the storages hand out and keep
+        snapshots only, so that a message changed by its owner never changes
+        the message of another collection."""
+
+        message = Message.__new__(Message)
+        message.uid = self.uid
+        message.body = self.body
+        message.unkown = self.unkown
+        message.destroyed = self.destroyed
+        message.mtime = self.mtime
+        message.flagBits = self.flagBits
+        message.addedBits = self.addedBits
+        message.removedBits = self.removedBits
+        message.stateAddedBits = self.stateAddedBits
+        message.stateRemovedBits = self.stateRemovedBits
+        return message
+
     def fakeDriverWrites(self, storageMessage):
         """Fake applying changes when written to a driver."""
 
         if self.unkown is False:
-            for flag, value in self.changes.items():
-                if value is not None:
-                    storageMessage.flags[flag] = self.changes[flag]
+            storageMessage.flagBits |= self.addedBits
+            storageMessage.flagBits &= ~self.removedBits
 
     def fakeStateWrites(self, storageMessage):
         """Fake applying changes when written to the state."""
 
         if self.unkown is False:
-            for flag, value in self.changes.items():
-                if value is not None:
-                    storageMessage.flags[flag] = self.changes[flag]
-
-            for flag, value in self.stateChanges.items():
-                if value is not None:
-                    storageMessage.flags[flag] = self.stateChanges[flag]
+            storageMessage.flagBits |= self.addedBits | self.stateAddedBits
+            storageMessage.flagBits &= ~self.removedBits
+            storageMessage.flagBits &= ~self.stateRemovedBits
 
     def getChanges(self):
         return self.changes
@@ -83,71 +408,56 @@ class Message(object):
     def hasChanges(self):
         """Changes must be written by the driver."""
 
-        if self.unkown is True:
+        if self.unkown is True or self.destroyed is True:
             return True
 
-        for change in self.changes.values():
-            if change is not None:
-                return True
-        return False
+        return (self.addedBits | self.removedBits) != 0
 
     def identical(self, message):
         """Compare the flags."""
 
         assert message.uid == self.uid
 
-        if message.flags != self.flags:
-            return False
+        return message.flagBits == self.flagBits
 
-        return True # Identical
+    def learnChangeBits(self, added, removed):
+        """Learn the flags added and removed since previous sync."""
+
+        diff = added | removed
+        if logLevel <= DEBUG:
+            for flag, bit in self.FLAGS.items():
+                if diff & bit:
+                    log("-> Learning change %s: %s: %s", self, flag,
+                        bool(added & bit), level=DEBUG)
+        self.addedBits = (self.addedBits & ~diff) | added
+        self.removedBits = (self.removedBits & ~diff) | removed
 
     def learnChanges(self, stateMessage):
         """Learn what was changed since stateMessage."""
 
-        for flag, value in stateMessage.getFlags().items():
-            if value != self.flags[flag]:
-                log("-> Learning change %s: %s: %s"%
-                    (self, flag, self.flags[flag]))
-                self.changes[flag] = self.flags[flag]
+        diff = stateMessage.flagBits ^ self.flagBits
+        self.learnChangeBits(diff & self.flagBits, diff & ~self.flagBits)
+
+    def markDestroyed(self):
+        self.destroyed = True
 
     def markImportant(self):
-        self.flags['important'] = True
+        self.flagBits |= self.FLAGS['important']
 
     def markRead(self):
-        self.flags['read'] = True
+        self.flagBits |= self.FLAGS['read']
 
     def markUnkown(self):
         self.unkown = True
 
-    def merge(self, message):
-        """Ignore changes identical in both sides for the drivers."""
-
-        assert message.getUID() == self.uid
-
-        otherChanges = deepcopy(message.getChanges())
-        ourChanges = deepcopy(self.changes)
-
-        for flag, change in otherChanges.items():
-            current = self.changes[flag]
-            # "change is None" means it did not change since previous sync.
-            if change is not None or current is not None:
-                if change == current:
-                    # Driver already have this change! Remove the change for the
-                    # drivers and only update the state.
-                    log("-> Ignoring change {%s: %s} from both sides"
-                        "for driver"% (flag, change))
-                    self.changes[flag] = None
-                    message.changes[flag] = None
-                    self.stateChanges[flag] = current
-
     def setDeleted(self):
-        self.flags['deleted'] = True
+        self.flagBits |= self.FLAGS['deleted']
 
     def unmarkImportant(self):
-        self.flags['important'] = False
+        self.flagBits &= ~self.FLAGS['important']
 
     def unmarkRead(self):
-        self.flags['read'] = False
+        self.flagBits &= ~self.FLAGS['read']
 
 
 class Messages(UserDict):
@@ -156,37 +466,1167 @@ class Messages(UserDict):
     def add(self, message):
         """Add or erase message."""
 
-        self.data[message.uid] = deepcopy(message)
+        self.data[message.uid] = message.copy()
 
-    def merge(self, theirMessages):
-        """Merge the changes."""
 
-        # Merge applies to both sides.
-        for uid, theirMessage in theirMessages.items():
-            if uid in self.data:
-                self.data[uid].merge(theirMessage)
+LEFT, RIGHT = 'left', 'right'
+
+def leftWins(leftMessage, rightMessage):
+    return LEFT
+
+def rightWins(leftMessage, rightMessage):
+    return RIGHT
+
+def newestWins(leftMessage, rightMessage):
+    """The side which changed the message last wins, left on ties."""
+
+    return RIGHT if rightMessage.mtime > leftMessage.mtime else LEFT
+
+
+class MergedChanges(Mapping):
+    """Changes of a side after the merge.
+
+    A view of the changes found where the merged messages replace theirs and
+    the dropped ones are hidden. Building the view costs nothing."""
+
+    def __init__(self, messages, merged, dropped, restored=()):
+        self.messages = messages
+        self.merged = merged # UID -> merged copy.
+        self.dropped = dropped
+        # UIDs of the merged copies to create again in the other side, which
+        # deleted them. Their body must be fetched before being written.
+        self.restored = restored
+
+    def __contains__(self, uid):
+        return uid in self.messages and uid not in self.dropped
+
+    def __getitem__(self, uid):
+        if uid in self.dropped:
+            raise KeyError(uid)
+        message = self.merged.get(uid)
+        if message is None:
+            message = self.messages[uid]
+        return message
+
+    def __iter__(self):
+        for uid in self.messages:
+            if uid not in self.dropped:
+                yield uid
+
+    def __len__(self):
+        return len(self.messages) - len(self.dropped)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def values(self):
+        if not self.merged and not self.dropped:
+            return self.messages.values()
+        return self._values()
+
+    def _values(self):
+        merged, dropped = self.merged, self.dropped
+        for uid, message in self.messages.items():
+            if uid not in dropped:
+                yield merged.get(uid, message)
+
+
+class Merge(object):
+    """Merge the changes found in both sides.
+
+    Only the messages changed in both sides are visited: they are looked up
+    from the smallest set of changes. The changes found are not mutated,
+    merged messages are copies.
+
+    Changes identical in both sides are removed for the drivers and only
+    recorded in the state. Changes of different flags are all written. A
+    flag changed in opposite ways in both sides is a conflict. Without
+    policy, the changes of both sides are written. With
+    policy(leftMessage, rightMessage) returning the winning side, only the
+    change of the winner is written for the flags in conflict.
+
+    A message deleted in a side and changed in the other is a conflict too.
+    Without policy, the deletion wins. With a policy, the deletion is
+    dropped when the changed side wins and the message is created again in
+    the side which deleted it. Deletions have no time: they lose with
+    newestWins."""
+
+    def __init__(self, policy=None, metrics=None):
+        self.policy = policy
+        self.metrics = metrics if metrics is not None else Metrics()
+
+    def merge(self, leftMessages, rightMessages):
+        """Return (leftChanges, rightChanges, stateChanges).
+
+        leftChanges and rightChanges are the MergedChanges to write to the
+        other side. stateChanges are the messages with changes for the state
+        only."""
+
+        left, right = leftMessages.data, rightMessages.data
+        leftMerged, rightMerged = {}, {}
+        leftDropped, rightDropped = set(), set()
+        leftRestored, rightRestored = [], []
+        stateChanges = Messages()
+        both = conflicts = 0
+
+        smaller, larger = (left, right) if len(left) < len(right) \
+            else (right, left)
+        for uid in smaller:
+            if uid not in larger:
+                continue
+            both += 1
+            leftMessage, rightMessage = left[uid], right[uid]
+            if leftMessage.destroyed is True or rightMessage.destroyed is True:
+                # When destroyed in both sides, both expunges are no-op.
+                if leftMessage.destroyed is True and \
+                        rightMessage.destroyed is True:
+                    continue
+                conflicts += 1
+                winner = LEFT if leftMessage.destroyed is True else RIGHT
+                if self.policy is not None:
+                    winner = self.policy(leftMessage, rightMessage)
+                if logLevel <= DEBUG:
+                    log("-> Conflict on deleted %s: %s wins", uid, winner,
+                        level=DEBUG)
+                if winner == LEFT:
+                    changed, dropped = leftMessage, rightDropped
+                    merged, restored = leftMerged, leftRestored
+                else:
+                    changed, dropped = rightMessage, leftDropped
+                    merged, restored = rightMerged, rightRestored
+                dropped.add(uid)
+                if changed.destroyed is False:
+                    # Written in full to the side which deleted it.
+                    merged[uid] = changed.copy()
+                    restored.append(uid)
+                continue
+
+            sameAdded = leftMessage.addedBits & rightMessage.addedBits
+            sameRemoved = leftMessage.removedBits & rightMessage.removedBits
+            same = sameAdded | sameRemoved
+            # Flags changed in opposite ways.
+            opposite = (leftMessage.addedBits & rightMessage.removedBits) | \
+                (leftMessage.removedBits & rightMessage.addedBits)
+            conflict = self.policy is not None and opposite != 0 and \
+                leftMessage.unkown is False and rightMessage.unkown is False
+            if same == 0 and conflict is False:
+                continue
+
+            leftMessage, rightMessage = leftMessage.copy(), rightMessage.copy()
+            if same != 0:
+                # Driver already have this change! Remove the change for the
+                # drivers and only update the state.
+                if logLevel <= DEBUG:
+                    for flag, bit in Message.FLAGS.items():
+                        if same & bit:
+                            log("-> Ignoring change {%s: %s} from both sides"
+                                "for driver", flag, bool(sameAdded & bit),
+                                level=DEBUG)
+                for message in (leftMessage, rightMessage):
+                    message.addedBits &= ~same
+                    message.removedBits &= ~same
+                leftMessage.stateAddedBits = \
+                    (leftMessage.stateAddedBits & ~same) | sameAdded
+                leftMessage.stateRemovedBits = \
+                    (leftMessage.stateRemovedBits & ~same) | sameRemoved
+            if conflict is True:
+                conflicts += 1
+                winner, loser = leftMessage, rightMessage
+                if self.policy(leftMessage, rightMessage) == RIGHT:
+                    winner, loser = rightMessage, leftMessage
+                if logLevel <= DEBUG:
+                    log("-> Conflict on %s: %s wins", uid,
+                        LEFT if winner is leftMessage else RIGHT, level=DEBUG)
+                # The change of the winner reverts the loser in its driver.
+                loser.addedBits &= ~opposite
+                loser.removedBits &= ~opposite
+
+            if leftMessage.hasChanges():
+                leftMerged[uid] = leftMessage
+            else:
+                leftDropped.add(uid)
+                if leftMessage.stateAddedBits | leftMessage.stateRemovedBits:
+                    stateChanges.data[uid] = leftMessage
+            if rightMessage.hasChanges():
+                rightMerged[uid] = rightMessage
+            else:
+                rightDropped.add(uid)
+
+        self.metrics.count("merge.both", both)
+        self.metrics.count("merge.conflicts", conflicts)
+        self.metrics.count("merge.restored",
+            len(leftRestored) + len(rightRestored))
+        return (MergedChanges(left, leftMerged, leftDropped, leftRestored),
+            MergedChanges(right, rightMerged, rightDropped, rightRestored),
+            stateChanges)
 
 
 # Fake any storage. Allows making this PoC more simple.
 class Storage(UserDict):
-    def search(self):
-        return self.data
+    digests = None # RangeDigests of the flags, see enableDigests().
+
+    def _digest(self, uid, oldMessage, newFlags):
+        if self.digests is not None:
+            self.digests.update(uid,
+                None if oldMessage is None else oldMessage.flagBits, newFlags)
+
+    def _record(self, message, fields):
+        if fields >= FULL:
+            return message.copy() # Never hand out our own message.
+        record = Message(message.uid)
+        if fields >= FLAGS:
+            record.flagBits = message.flagBits
+            record.mtime = message.mtime
+        return record
+
+    def enableDigests(self):
+        """Maintain the digests of the flags by UID ranges from now on. The
+        messages must then be changed through the methods only."""
+
+        self.digests = RangeDigests(self.data.values())
+
+    def fetch(self, uids, fields=FULL):
+        """Return the messages of these UIDs, by UID."""
+
+        messages = {}
+        for uid in uids:
+            message = self.data.get(uid)
+            if message is not None:
+                messages[uid] = self._record(message, fields)
+        return messages
+
+    def search(self, fields=FULL):
+        """Iterate over the messages with the requested fields only."""
+
+        for message in self.data.values():
+            yield self._record(message, fields)
+
+    def searchSorted(self, fields=FULL):
+        """Same as search() in UID order. The messages removed meanwhile
+        are skipped."""
+
+        data = self.data
+        for uid in sorted(data):
+            message = data.get(uid)
+            if message is not None:
+                yield self._record(message, fields)
 
 class StateStorage(Storage):
     """Would run in a worker."""
 
+    def __init__(self, *args, **kw):
+        self.syncedModseqs = {} # Driver name -> highest modseq in sync.
+        self.tombstones = set() # UIDs expunged in both sides.
+        super(StateStorage, self).__init__(*args, **kw)
+
+    def getSyncedModseq(self, name):
+        """Return the modseq up to which the driver is in sync, or 0."""
+
+        return self.syncedModseqs.get(name, 0)
+
+    def getTombstones(self):
+        """Return the UIDs of the messages expunged in both sides.
+
+        A tombstone is recorded once the deletion was written so that the
+        deletion is not found again. A message still having a tombstoned UID
+        in a driver is not a new message: UIDs are never reused."""
+
+        return self.tombstones
+
+    def purgeTombstones(self, keep):
+        """Forget the tombstones of the UIDs not in keep, the UIDs still seen
+        in a driver. Return the number of tombstones purged."""
+
+        purged = self.tombstones.difference(keep)
+        self.tombstones.difference_update(purged)
+        return len(purged)
+
+    def setSyncedModseq(self, name, modseq):
+        self.syncedModseqs[name] = modseq
+
+    def view(self):
+        """Return a read-only mapping UID -> message for lookups. Tombstones
+        are not included."""
+
+        return self.data
+
     def update(self, message):
         """StateDriver Must Contain MetaData for last synced messages rather
         than full emails. For now we are putting full messages."""
 
         #TODO: we have to later think of its implementation and format.
         uid = message.getUID()
+        if message.destroyed is True:
+            self._digest(uid, self.data.pop(uid, None), None)
+            self.tombstones.add(uid)
+            return
+        self.tombstones.discard(uid) # Replaced by the message.
         if uid in self.data:
             # Update message in storage.
             storageMessage = self.data[uid]
+            oldFlags = storageMessage.flagBits
             message.fakeStateWrites(storageMessage)
+            if self.digests is not None:
+                self.digests.update(uid, oldFlags, storageMessage.flagBits)
+        else:
+            # Not shared with the driver which wrote it.
+            self.data[uid] = message.copy()
+            self._digest(uid, None, message.flagBits)
+
+    def flush(self):
+        """Wait for the pending records. Nothing is pending here."""
+
+        pass
+
+    def updateBatch(self, messages):
+        """Record many messages at once."""
+
+        for message in messages:
+            self.update(message)
+
+
+class WriteBehindState(object):
+    """Record the state of a StateStorage in a background worker.
+
+    Records are queued by updateBatch() and the worker coalesces the queued
+    records into batches. Only messages successfully written by a driver
+    must be queued: after a crash, pending records are lost and the changes
+    are found again on next sync, but the state never records a write which
+    did not happen. Reads wait for the pending records."""
+
+    def __init__(self, state, batchSize=4096):
+        self.state = state
+        self.batchSize = batchSize
+        self.error = None
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+
+    @property
+    def data(self):
+        self.flush()
+        return self.state.data
+
+    @property
+    def digests(self):
+        self.flush()
+        return self.state.digests
+
+    def _work(self):
+        while True:
+            messages = self.queue.get()
+            if messages is None:
+                self.queue.task_done()
+                return
+            batch, done = list(messages), 1
+            while len(batch) < self.batchSize:
+                try:
+                    messages = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if messages is None:
+                    self.queue.put(None) # Stop after this batch.
+                    self.queue.task_done()
+                    break
+                batch.extend(messages)
+                done += 1
+            try:
+                self.state.updateBatch(batch)
+            except Exception as e:
+                self.error = e
+            for _ in range(done):
+                self.queue.task_done()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.worker.join()
+        if hasattr(self.state, 'close'):
+            self.state.close()
+
+    def enableDigests(self):
+        self.flush()
+        self.state.enableDigests()
+
+    def flush(self):
+        """Barrier: wait until all the queued records are recorded."""
+
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def getSyncedModseq(self, name):
+        return self.state.getSyncedModseq(name)
+
+    def getTombstones(self):
+        self.flush()
+        return self.state.getTombstones()
+
+    def purgeTombstones(self, keep):
+        self.flush()
+        return self.state.purgeTombstones(keep)
+
+    def search(self, fields=FULL):
+        self.flush()
+        return self.state.search(fields)
+
+    def searchSorted(self, fields=FULL):
+        self.flush()
+        return self.state.searchSorted(fields)
+
+    def setSyncedModseq(self, name, modseq):
+        self.flush()
+        self.state.setSyncedModseq(name, modseq)
+
+    def view(self):
+        self.flush()
+        return self.state.view()
+
+    def update(self, message):
+        self.updateBatch([message])
+
+    def updateBatch(self, messages):
+        self.queue.put(list(messages))
+
+
+class MappedRecords(object):
+    """Memory-mapped file of fixed width (UID, flags, modseq) records sorted
+    by UID.
+
+    Records are read in place: nothing is deserialized until looked up."""
+
+    FIELDS = 3
+
+    def __init__(self, path):
+        self.fd = open(path, 'rb')
+        size = os.fstat(self.fd.fileno()).st_size
+        size -= size % (8 * self.FIELDS)
+        if size > 0:
+            self.map = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)[:size].cast('q')
+        else:
+            self.map = None
+            self.view = memoryview(b'').cast('q')
+
+    def __getitem__(self, i):
+        """UID of record i. Allows bisect on the records."""
+
+        return self.view[i * self.FIELDS]
+
+    def __len__(self):
+        return len(self.view) // self.FIELDS
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+        self.fd.close()
+
+    def find(self, uid):
+        """Return the index of the record for this UID or -1."""
+
+        count = len(self)
+        if count < 1:
+            return -1
+        # Direct offset when the UIDs are dense, binary search otherwise.
+        i = uid - self[0]
+        if 0 <= i < count and self[i] == uid:
+            return i
+        i = bisect_left(self, uid)
+        if i < count and self[i] == uid:
+            return i
+        return -1
+
+    def get(self, uid):
+        """Return (flags, modseq) for this UID or None."""
+
+        i = self.find(uid)
+        if i < 0:
+            return None
+        offset = i * self.FIELDS
+        return self.view[offset + 1], self.view[offset + 2]
+
+    def highestModseq(self):
+        return max(self.view[2::self.FIELDS], default=0)
+
+    def records(self):
+        view, fields = self.view, self.FIELDS
+        for offset in range(0, len(view), fields):
+            yield view[offset], view[offset + 1], view[offset + 2]
+
+
+class StateRecords(Mapping):
+    """Read-only view of the records of a PersistentStateStorage.
+
+    Messages are only built when looked up."""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __contains__(self, uid):
+        return self.storage.getRecord(uid) is not None
+
+    def __getitem__(self, uid):
+        record = self.storage.getRecord(uid)
+        if record is None:
+            raise KeyError(uid)
+        message = Message(uid)
+        message.flagBits = record[0]
+        return message
+
+    def __iter__(self):
+        return self.storage.uids()
+
+    def __len__(self):
+        return self.storage.count()
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class PersistentStateStorage(StateStorage):
+    """State storage persisted on disk.
+
+    Only the UID, the flag bits and the modseq of the last write of the
+    messages are stored, as fixed width records. The snapshot file is sorted
+    by UID. Updates are appended to a journal which is replayed at load time
+    and merged into the snapshot by compact(). The files are loaded on first
+    use.
+
+    With useMmap=True, the snapshot is memory-mapped and looked up in place;
+    only the journal is loaded in memory.
+
+    Tombstones are records with the TOMBSTONE flags. They are never written
+    to the snapshot: compact() writes the tombstones not purged at the start
+    of the new journal. Purged tombstones are journaled as PURGED records
+    until the next compact(). Records with negative flags are not
+    messages."""
+
+    RECORD = struct.Struct('=qqq') # Native, to be read back with array('q').
+    TOMBSTONE = -1 # Flags of the records of expunged messages.
+    PURGED = -2 # Flags of the records of purged tombstones.
+    COMPACT_MIN = 4096 # Journal records before considering a compaction.
+    COMPACT_RATIO = 0.5 # Compact when journal > ratio * snapshot records.
+
+    def __init__(self, path, useMmap=False):
+        # Not calling UserDict.__init__(): data is a view on the records.
+        self.path = path
+        self.journalPath = path + '.journal'
+        self.syncedModseqsPath = path + '.modseqs'
+        self.syncedModseqs = None
+        self.useMmap = useMmap
+        self.records = None # UID -> (flags, modseq). Journal only if mmap.
+        self.mapped = None # MappedRecords of the snapshot if mmap.
+        self.tombstones = None
+        self.live = 0 # Records of messages.
+        self.modseq = 0 # Highest modseq written.
+        self.journal = None
+        self.journalRecords = 0
+        self.snapshotRecords = 0
+        self.loadLock = threading.Lock() # Both sides may load at once.
+
+    @property
+    def data(self):
+        self.load()
+        return StateRecords(self)
+
+    def _readRecords(self, path):
+        records = array('q')
+        try:
+            with open(path, 'rb') as fd:
+                content = fd.read()
+        except FileNotFoundError:
+            return records
+        # Ignore a truncated record from an interrupted write.
+        size = len(content) - len(content) % self.RECORD.size
+        records.frombytes(content[:size])
+        return records
+
+    def _append(self, chunk):
+        """Append packed records to the journal."""
+
+        if self.journal is None:
+            self.journal = open(self.journalPath, 'ab')
+        self.journal.write(chunk)
+        self.journal.flush()
+        self.journalRecords += len(chunk) // self.RECORD.size
+        if self.journalRecords > max(self.COMPACT_MIN,
+                self.COMPACT_RATIO * self.snapshotRecords):
+            self.compact()
+
+    def _sortedRecords(self):
+        """Yield all the (uid, flags, modseq) records sorted by UID."""
+
+        overlay = sorted(self.records.items())
+        if self.mapped is None:
+            for uid, (flags, modseq) in overlay:
+                yield uid, flags, modseq
+            return
+
+        # Merge the journal over the snapshot.
+        overlay = iter(overlay)
+        pending = next(overlay, None)
+        for uid, flags, modseq in self.mapped.records():
+            while pending is not None and pending[0] < uid:
+                yield pending[0], pending[1][0], pending[1][1]
+                pending = next(overlay, None)
+            if pending is not None and pending[0] == uid:
+                continue
+            yield uid, flags, modseq
+        while pending is not None:
+            yield pending[0], pending[1][0], pending[1][1]
+            pending = next(overlay, None)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+            self.records = None # Reload on next use.
+
+    def compact(self):
+        """Merge the journal into a new snapshot."""
+
+        self.load()
+        records = array('q')
+        tombstones = array('q')
+        for record in self._sortedRecords():
+            if record[1] < 0:
+                if record[0] in self.tombstones:
+                    tombstones.extend(record)
+                continue
+            records.extend(record)
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'wb') as fd:
+            records.tofile(fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmpPath, self.path)
+
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journalPath, 'wb')
+        tombstones.tofile(self.journal)
+        self.journal.flush()
+        self.journalRecords = len(tombstones) // MappedRecords.FIELDS
+        self.snapshotRecords = self.live = len(records) // MappedRecords.FIELDS
+        if self.useMmap is True:
+            self.mapped.close()
+            self.mapped = MappedRecords(self.path)
+            self.records = {uid: (self.TOMBSTONE, modseq)
+                for uid, modseq in zip(tombstones[0::3], tombstones[2::3])}
+
+    def count(self):
+        self.load()
+        return self.live
+
+    def getRecord(self, uid):
+        """Return (flags, modseq) for this UID or None."""
+
+        record = self.records.get(uid)
+        if record is None and self.mapped is not None:
+            record = self.mapped.get(uid)
+        if record is not None and record[0] < 0:
+            return None
+        return record
+
+    def getSyncedModseq(self, name):
+        self.load()
+        return self.syncedModseqs.get(name, 0)
+
+    def getTombstones(self):
+        self.load()
+        return self.tombstones
+
+    def load(self):
+        """Load the files on first use. The records are published last: they
+        tell the others that the state is loaded."""
+
+        if self.records is not None:
+            return
+        with self.loadLock:
+            if self.records is None:
+                self._load()
+
+    def _load(self):
+        syncedModseqs = {}
+        try:
+            with open(self.syncedModseqsPath) as fd:
+                for line in fd:
+                    name, modseq = line.split()
+                    syncedModseqs[name] = int(modseq)
+        except FileNotFoundError:
+            pass
+        journal = self._readRecords(self.journalPath)
+        records = {}
+        mapped = None
+        if self.useMmap is True:
+            if not os.path.exists(self.path):
+                open(self.path, 'ab').close()
+            mapped = MappedRecords(self.path)
+            snapshotRecords = len(mapped)
+            modseq = mapped.highestModseq()
+        else:
+            snapshot = self._readRecords(self.path)
+            records.update(zip(snapshot[0::3],
+                zip(snapshot[1::3], snapshot[2::3])))
+            snapshotRecords = len(snapshot) // 3
+            modseq = max(snapshot[2::3], default=0)
+        records.update(zip(journal[0::3],
+            zip(journal[1::3], journal[2::3])))
+        tombstones = {uid for uid in journal[0::3]
+            if records[uid][0] == self.TOMBSTONE}
+        if mapped is None:
+            # Nothing to hide below.
+            for uid in set(journal[0::3]):
+                if records[uid][0] == self.PURGED:
+                    del records[uid]
+        live = sum(1 for flags, _ in records.values() if flags >= 0)
+        if mapped is not None:
+            # The snapshot records not replaced by the journal.
+            live += len(mapped) - sum(1 for uid in records
+                if mapped.find(uid) >= 0)
+
+        self.syncedModseqs = syncedModseqs
+        self.mapped = mapped
+        self.tombstones = tombstones
+        self.live = live
+        self.snapshotRecords = snapshotRecords
+        self.journalRecords = len(journal) // 3
+        self.modseq = max(modseq, max(journal[2::3], default=0))
+        self.records = records
+
+    def purgeTombstones(self, keep):
+        """Purged tombstones are journaled and dropped from the files by
+        compact()."""
+
+        self.load()
+        purged = self.tombstones.difference(keep)
+        self.tombstones.difference_update(purged)
+        chunk = bytearray()
+        for uid in sorted(purged):
+            modseq = self.records[uid][1]
+            if self.mapped is None:
+                # Nothing to hide below.
+                del self.records[uid]
+            else:
+                self.records[uid] = (self.PURGED, modseq)
+            chunk += self.RECORD.pack(uid, self.PURGED, modseq)
+        if chunk:
+            self._append(chunk)
+        return len(purged)
+
+    def search(self, fields=FULL):
+        """Iterate over the records. There are no bodies in the state."""
+
+        records = self.data
+        for uid in records:
+            yield records[uid]
+
+    def setSyncedModseq(self, name, modseq):
+        self.load()
+        self.syncedModseqs[name] = modseq
+        tmpPath = self.syncedModseqsPath + '.tmp'
+        with open(tmpPath, 'w') as fd:
+            for name, modseq in sorted(self.syncedModseqs.items()):
+                fd.write("%s %i\n"% (name, modseq))
+        os.replace(tmpPath, self.syncedModseqsPath)
+
+    def sync(self):
+        """Make the journal durable."""
+
+        if self.journal is not None:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def view(self):
+        return self.data
+
+    def uids(self):
+        self.load()
+        for uid, (flags, _) in self.records.items():
+            if flags >= 0:
+                yield uid
+        if self.mapped is not None:
+            for uid, _, _ in self.mapped.records():
+                if uid not in self.records:
+                    yield uid
+
+    def update(self, message):
+        self.updateBatch([message])
+
+    def updateBatch(self, messages):
+        """Record many messages with one journal write."""
+
+        self.load()
+        chunk = bytearray()
+        for message in messages:
+            uid = message.getUID()
+            record = self.getRecord(uid)
+            if message.destroyed is True:
+                flagBits = self.TOMBSTONE
+                self.tombstones.add(uid)
+            elif record is not None:
+                storageMessage = Message(uid)
+                storageMessage.flagBits = record[0]
+                message.fakeStateWrites(storageMessage)
+                flagBits = storageMessage.flagBits
+            else:
+                flagBits = message.flagBits
+                self.tombstones.discard(uid) # Replaced by the message.
+            self.live += (flagBits >= 0) - (record is not None)
+            if self.digests is not None:
+                self.digests.update(uid, None if record is None else record[0],
+                    None if flagBits == self.TOMBSTONE else flagBits)
+            self.modseq += 1
+            self.records[uid] = (flagBits, self.modseq)
+            chunk += self.RECORD.pack(uid, flagBits, self.modseq)
+        if len(chunk) < 1:
+            return
+        self._append(chunk)
+
+
+class FlagColumns(object):
+    """UIDs and flags of a storage laid out as aligned columns.
+
+    Backed by NumPy when available, by the array module otherwise. UIDs must
+    be integers. When sort is True, the columns are sorted by UID."""
+
+    def __init__(self, messages, sort=False, useNumpy=True):
+        self.numpy = numpy if useNumpy else None
+        uids, flags = array('q'), array('q')
+        for message in messages:
+            uids.append(message.uid)
+            flags.append(message.flagBits)
+        if self.numpy is not None:
+            self.uids = numpy.frombuffer(uids, numpy.int64)
+            self.flags = numpy.frombuffer(flags, numpy.int64)
+            if sort:
+                order = numpy.argsort(self.uids, kind='stable')
+                self.uids = self.uids[order]
+                self.flags = self.flags[order]
+        else:
+            self.uids, self.flags = uids, flags
+
+    def __len__(self):
+        return len(self.uids)
+
+    @classmethod
+    def fromBytes(cls, uids, flags, useNumpy=True):
+        """Return the columns from the bytes of int64 arrays."""
+
+        columns = cls.__new__(cls)
+        columns.numpy = numpy if useNumpy else None
+        if columns.numpy is not None:
+            columns.uids = numpy.frombuffer(uids, numpy.int64)
+            columns.flags = numpy.frombuffer(flags, numpy.int64)
+        else:
+            columns.uids, columns.flags = array('q'), array('q')
+            columns.uids.frombytes(uids)
+            columns.flags.frombytes(flags)
+        return columns
+
+    def changes(self, stateColumns):
+        """Diff our flags against the (sorted) columns of the state.
+
+        Return (index, added, removed, unknown) of the messages which are new
+        or have changed, in our order. index are their positions in our
+        columns."""
+
+        if self.numpy is None:
+            return self._diffArrays(stateColumns)
+
+        uids, flags = self.uids, self.flags
+        stateUIDs = stateColumns.uids
+        if len(stateUIDs) < 1:
+            zeros = numpy.zeros(len(uids), numpy.int64)
+            return (numpy.arange(len(uids)), zeros, zeros,
+                numpy.ones(len(uids), bool))
+
+        positions = numpy.searchsorted(stateUIDs, uids)
+        numpy.minimum(positions, len(stateUIDs) - 1, out=positions)
+        known = stateUIDs[positions] == uids
+        diff = numpy.where(known, flags ^ stateColumns.flags[positions], 0)
+        report = (diff != 0) | ~known
+        diff = diff[report]
+        flags = flags[report]
+        return (numpy.flatnonzero(report), diff & flags, diff & ~flags,
+            ~known[report])
+
+    def diff(self, stateColumns):
+        """Same as changes() with the lists (uids, added, removed, unknown)."""
+
+        index, added, removed, unknown = self.changes(stateColumns)
+        if self.numpy is None:
+            return [self.uids[i] for i in index], added, removed, unknown
+        return (self.uids[index].tolist(), added.tolist(), removed.tolist(),
+            unknown.tolist())
+
+    def diffSharded(self, stateColumns, pool, shards):
+        """Same as diff() and missing() with the UID space split into shards
+        diffed in the pool. Only the bytes of the columns of each shard are
+        sent to the workers. Return (uids, added, removed, unknown,
+        missing)."""
+
+        if shards < 2 or len(stateColumns) < 1:
+            return self.diff(stateColumns) + (self.missing(stateColumns),)
+
+        if self.numpy is not None:
+            low, high = int(stateColumns.uids[0]), int(stateColumns.uids[-1])
         else:
-            self.data[uid] = message
+            low, high = min(stateColumns.uids), max(stateColumns.uids)
+        bounds = [low + (high - low + 1) * i // shards
+            for i in range(1, shards)]
+        parts = self._partition(bounds)
+        futures = [pool.submit(diffShard, uids.tobytes(), flags.tobytes(),
+                stateUIDs.tobytes(), stateFlags.tobytes(),
+                self.numpy is not None)
+            for (_, uids, flags), (_, stateUIDs, stateFlags)
+            in zip(parts, stateColumns._partition(bounds))]
+
+        changes, missing = [], array('q')
+        for (positions, _, _), future in zip(parts, futures):
+            columns = []
+            for content in future.result():
+                column = array('q')
+                column.frombytes(content)
+                columns.append(column)
+            index, added, removed, unknown, shardMissing = columns
+            for i, addedBits, removedBits, new in zip(index, added, removed,
+                    unknown):
+                changes.append((int(positions[i]), addedBits, removedBits,
+                    new == 1))
+            missing.extend(shardMissing) # Shards are in UID order.
+        changes.sort() # In our order.
+
+        uids, added, removed, unknown = [], [], [], []
+        for position, addedBits, removedBits, new in changes:
+            uids.append(int(self.uids[position]))
+            added.append(addedBits)
+            removed.append(removedBits)
+            unknown.append(new)
+        return uids, added, removed, unknown, missing.tolist()
+
+    def missing(self, stateColumns):
+        """Return the sorted UIDs of stateColumns missing in our columns."""
+
+        if self.numpy is not None:
+            return numpy.setdiff1d(stateColumns.uids, self.uids,
+                assume_unique=True).tolist()
+        return sorted(set(stateColumns.uids).difference(self.uids))
+
+    def _diffArrays(self, stateColumns):
+        stateFlags = dict(zip(stateColumns.uids, stateColumns.flags))
+        index, added, removed, unknown = [], [], [], []
+        for i, (uid, flags) in enumerate(zip(self.uids, self.flags)):
+            stateBits = stateFlags.get(uid)
+            if stateBits is None:
+                diff = 0
+            else:
+                diff = flags ^ stateBits
+                if diff == 0:
+                    continue
+            index.append(i)
+            added.append(diff & flags)
+            removed.append(diff & ~flags)
+            unknown.append(stateBits is None)
+        return index, added, removed, unknown
+
+    def _partition(self, bounds):
+        """Split the columns by the UID ranges starting at bounds. Return the
+        (positions, uids, flags) arrays of each range, in our order."""
+
+        if self.numpy is not None:
+            shardIds = numpy.searchsorted(bounds, self.uids, side='right')
+            order = numpy.argsort(shardIds, kind='stable')
+            parts, start = [], 0
+            for count in numpy.bincount(shardIds, minlength=len(bounds) + 1):
+                positions = order[start:start + count]
+                parts.append((positions, self.uids[positions],
+                    self.flags[positions]))
+                start += count
+            return parts
+
+        parts = [(array('q'), array('q'), array('q'))
+            for _ in range(len(bounds) + 1)]
+        for position, (uid, flags) in enumerate(zip(self.uids, self.flags)):
+            positions, uids, flagColumn = parts[bisect_right(bounds, uid)]
+            positions.append(position)
+            uids.append(uid)
+            flagColumn.append(flags)
+        return parts
+
+
+def diffShard(uids, flags, stateUIDs, stateFlags, useNumpy):
+    """Diff a shard of the flag columns. Used by the worker processes: the
+    arguments and the results are the bytes of int64 arrays."""
+
+    columns = FlagColumns.fromBytes(uids, flags, useNumpy)
+    stateColumns = FlagColumns.fromBytes(stateUIDs, stateFlags, useNumpy)
+    results = columns.changes(stateColumns) + (columns.missing(stateColumns),)
+    if useNumpy is True and numpy is not None:
+        return tuple(numpy.asarray(column, numpy.int64).tobytes()
+            for column in results)
+    return tuple(array('q', column).tobytes() for column in results)
+
+
+class FakeServer(object):
+    """Fake an IMAP server for the connection pools.
+
+    Opening a connection costs connectLatency seconds, like the TCP, TLS and
+    LOGIN round trips of a real server."""
+
+    def __init__(self, host, connectLatency=0.0):
+        self.host = host
+        self.connectLatency = connectLatency
+        self.connections = 0 # Connections opened so far.
+        self.generation = 0 # Connections of older generations are dropped.
+        self.lock = threading.Lock()
+
+    def connect(self):
+        sleep(self.connectLatency)
+        with self.lock:
+            self.connections += 1
+        return Connection(self)
+
+    def restart(self):
+        """Drop all the open connections."""
+
+        self.generation += 1
+
+
+class Connection(object):
+    """Fake a connection to a FakeServer."""
+
+    def __init__(self, server):
+        self.server = server
+        self.generation = server.generation
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def noop(self):
+        """Return whether the connection still works, like the NOOP
+        command."""
+
+        return self.closed is False and \
+            self.generation == self.server.generation
+
+
+class ConnectionPool(object):
+    """Share the connections to the servers between the drivers.
+
+    At most maxPerHost connections are open to a host: beyond, acquire()
+    waits for a connection to be released. Released connections are kept
+    for idleTimeout seconds and checked with a NOOP before being reused.
+    The most recently released connection is reused first so that the
+    others expire.
+
+    A request must release its connection before acquiring another one or
+    two requests could wait for each other."""
+
+    def __init__(self, maxPerHost=2, idleTimeout=60.0, clock=time):
+        self.maxPerHost = maxPerHost
+        self.idleTimeout = idleTimeout
+        self.clock = clock
+        self.metrics = Metrics() # For the lifetime of the pool.
+        self.condition = threading.Condition()
+        self.idle = {} # Host -> [(release time, connection)], oldest first.
+        self.opened = {} # Host -> number of connections, idle or not.
+
+    def _closed(self, host, connection):
+        # Must be called with the condition held.
+        connection.close()
+        self.opened[host] -= 1
+        self.condition.notify()
+
+    def _expire(self, host):
+        # Must be called with the condition held.
+        idle = self.idle.get(host)
+        if not idle:
+            return
+        deadline = self.clock() - self.idleTimeout
+        expired = 0
+        while expired < len(idle) and idle[expired][0] <= deadline:
+            self._closed(host, idle[expired][1])
+            expired += 1
+        if expired > 0:
+            del idle[:expired]
+            self.metrics.count("pool.expired", expired)
+
+    def acquire(self, server):
+        """Return an idle connection to the server or open a new one."""
+
+        host = server.host
+        while True:
+            connection = None
+            with self.metrics.timer("pool.wait"), self.condition:
+                while True:
+                    self._expire(host)
+                    idle = self.idle.get(host)
+                    if idle:
+                        connection = idle.pop()[1]
+                        break
+                    if self.opened.get(host, 0) < self.maxPerHost:
+                        # Reserve the slot of the new connection.
+                        self.opened[host] = self.opened.get(host, 0) + 1
+                        break
+                    self.condition.wait()
+
+            if connection is None:
+                try:
+                    with self.metrics.timer("pool.connect"):
+                        connection = server.connect()
+                except:
+                    with self.condition:
+                        self.opened[host] -= 1
+                        self.condition.notify()
+                    raise
+                self.metrics.count("pool.opened")
+                return connection
+            # Health check out of the lock: it is a round trip.
+            if connection.noop() is True:
+                self.metrics.count("pool.reused")
+                return connection
+            self.metrics.count("pool.broken")
+            with self.condition:
+                self._closed(host, connection)
+
+    def close(self):
+        """Close the idle connections."""
+
+        with self.condition:
+            for host, idle in self.idle.items():
+                for _, connection in idle:
+                    self._closed(host, connection)
+            self.idle.clear()
+
+    @contextmanager
+    def connection(self, server):
+        connection = self.acquire(server)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def release(self, connection):
+        with self.condition:
+            self.idle.setdefault(connection.server.host, []).append(
+                (self.clock(), connection))
+            self.condition.notify()
+
+    def reuseRate(self):
+        """Return the fraction of the connections acquired which were
+        reused."""
+
+        counters = self.metrics.snapshot()['counters']
+        reused = counters.get('pool.reused', 0)
+        acquired = reused + counters.get('pool.opened', 0)
+        return reused / acquired if acquired > 0 else 0.0
 
 
 #TODO: fake real drivers.
@@ -194,29 +1634,407 @@ class StateStorage(Storage):
 class Driver(Storage):
     """Fake a driver."""
 
+    CONDSTORE = False # See ModseqDriver.
+    # True fails the next write only. A float fails this fraction of the
+    # writes, at random.
     FakeDriverWriteError = False
+    # The requests hold a connection of pool to server, if any.
+    pool = None
+    server = None
 
     def __init__(self, name, *args, **kw):
         self.name = name
+        self.metrics = Metrics() # Replaced by the engine.
+        self.faults = random.Random(name) # Draws of FakeDriverWriteError.
         super(Driver, self).__init__(*args, **kw)
 
+    @contextmanager
+    def connection(self):
+        """Hold a connection to our server for a request."""
+
+        if self.pool is None:
+            yield None
+            return
+        with self.metrics.timer("driver.%s.acquire"% self.name):
+            connection = self.pool.acquire(self.server)
+        try:
+            yield connection
+        finally:
+            self.pool.release(connection)
+
     def fakeChange(self, message):
         """Add or erase with newMessage."""
 
-        #FIXME: updates and new messages are handled. Not the deletions.
-        self.data[message.uid] = deepcopy(message)
+        message = message.copy()
+        message.mtime = time()
+        self._digest(message.uid, self.data.get(message.uid),
+            message.flagBits)
+        self.data[message.uid] = message
 
-    def update(self, message):
-        if self.FakeDriverWriteError is True:
+    def fakeDelete(self, uid):
+        """Expunge the message from the mailbox."""
+
+        self._digest(uid, self.data.pop(uid), None)
+
+    def _fakeWrite(self):
+        fault = self.FakeDriverWriteError
+        if fault is True:
             self.FakeDriverWriteError = False
-            raise IOError("write by driver failed")
+        elif fault is False or self.faults.random() >= fault:
+            return
+        raise IOError("write by driver failed")
+
+    def appendStream(self, message, chunks):
+        """Store a new message with the body read from chunks."""
+
+        # Would be written to the mailbox as it comes. Bodies are immutable.
+        message.body = b''.join(chunks)
+        self.append(message)
+
+    def append(self, message):
+        """Store a new message."""
+
+        with self.metrics.timer("driver.%s.append"% self.name), \
+                self.connection():
+            self._fakeWrite()
+            uid = message.getUID()
+            self._digest(uid, self.data.get(uid), message.flagBits)
+            self.data[uid] = message.copy() # Not shared with the caller.
+        if message.body is not None:
+            self.metrics.count("driver.%s.bytes"% self.name, len(message.body))
+
+    def expunge(self, ranges):
+        """Remove all the messages in the UID ranges with one request.
+        Missing messages are ignored."""
+
+        with self.metrics.timer("driver.%s.expunge"% self.name), \
+                self.connection():
+            self._fakeWrite()
+            for first, last in ranges:
+                for uid in range(first, last + 1):
+                    self._digest(uid, self.data.pop(uid, None), None)
+
+    def fetch(self, uids, fields=FULL):
+        with self.connection():
+            return super(Driver, self).fetch(uids, fields)
+
+    def readBody(self, uid, chunkSize=CHUNK_SIZE):
+        """Iterate over the body of a message in chunks, like partial
+        fetches of BODY[]. Chunks are views on the body, not copies.
+
+        Each chunk is fetched with its own connection, released before the
+        chunk is yielded: the reader may then wait, for the byte budget
+        for example, without holding a connection another stream needs.
+
+        Raise IOError if the message is expunged before its last chunk, like
+        a failed write: the message is then retried or found again on next
+        sync."""
+
+        with self.connection():
+            message = self.data.get(uid)
+        if message is None:
+            raise IOError("message %s was expunged"% uid)
+        body = message.body
+        if body is None:
+            return
+        if isinstance(body, str):
+            body = body.encode()
+        view = memoryview(body)
+        for offset in range(0, len(view), chunkSize):
+            with self.connection(): # Would be a partial fetch.
+                if uid not in self.data:
+                    raise IOError("message %s was expunged"% uid)
+                chunk = view[offset:offset + chunkSize]
+            yield chunk
+
+    def search(self, fields=FULL):
+        with self.connection():
+            yield from super(Driver, self).search(fields)
+
+    def searchSorted(self, fields=FULL):
+        """Same as search() in UID order, fetched by pages of SEARCH_PAGE
+        UIDs. The connection is released between the pages so that the
+        driver can be written while searched."""
+
+        with self.connection():
+            uids = sorted(self.data) # Would be UID SEARCH ALL.
+        for start in range(0, len(uids), SEARCH_PAGE):
+            yield from self.fetch(uids[start:start + SEARCH_PAGE],
+                fields).values()
+
+    def store(self, ranges, added, removed):
+        """Add and remove flags of all the messages in the UID ranges with
+        one request."""
+
+        with self.metrics.timer("driver.%s.store"% self.name), \
+                self.connection():
+            self._fakeWrite()
+            for first, last in ranges:
+                for uid in range(first, last + 1):
+                    storageMessage = self.data.get(uid)
+                    if storageMessage is not None:
+                        oldFlags = storageMessage.flagBits
+                        storageMessage.flagBits |= added
+                        storageMessage.flagBits &= ~removed
+                        if self.digests is not None:
+                            self.digests.update(uid, oldFlags,
+                                storageMessage.flagBits)
+
+    def update(self, message):
         uid = message.getUID()
-        if uid in self.data:
-            # Update message in storage.
-            storageMessage = self.data[uid]
-            message.fakeDriverWrites(storageMessage)
-        else:
-            self.data[uid] = message
+        if message.destroyed is True:
+            self.expunge([(uid, uid)])
+            return
+        with self.connection():
+            self._fakeWrite()
+            if uid in self.data:
+                # Update message in storage.
+                storageMessage = self.data[uid]
+                oldFlags = storageMessage.flagBits
+                message.fakeDriverWrites(storageMessage)
+                if self.digests is not None:
+                    self.digests.update(uid, oldFlags,
+                        storageMessage.flagBits)
+            else:
+                self._digest(uid, None, message.flagBits)
+                self.data[uid] = message.copy() # Not shared with the caller.
+
+    def updateBatch(self, messages, onWritten=None, bodies=None):
+        """Update many messages.
+
+        Messages with the same flag changes are written with one store() per
+        group. Return the lists of written messages and of failed
+        (message, error) pairs. If set, onWritten is called with the
+        messages of each successful request. New messages without a body
+        are streamed from bodies(uid), a generator of chunks."""
+
+        written, failed = [], []
+        groups = {}
+
+        def done(messages):
+            written.extend(messages)
+            if onWritten is not None:
+                onWritten(messages)
+
+        unchanged, destroyed = [], []
+        for message in messages:
+            if message.destroyed is True:
+                destroyed.append(message)
+            elif message.getUID() not in self.data:
+                try:
+                    if bodies is not None and message.body is None:
+                        chunks = bodies(message.getUID())
+                        try:
+                            self.appendStream(message, chunks)
+                        finally:
+                            chunks.close()
+                    else:
+                        self.append(message)
+                    done([message])
+                except IOError as e:
+                    failed.append((message, e))
+            elif message.unkown is True or not message.hasChanges():
+                unchanged.append(message) # Nothing to write.
+            else:
+                key = (message.addedBits, message.removedBits)
+                groups.setdefault(key, []).append(message)
+        if unchanged:
+            done(unchanged)
+
+        if destroyed:
+            try:
+                self.expunge(uidRanges(m.getUID() for m in destroyed))
+                done(destroyed)
+            except IOError as e:
+                failed.extend((message, e) for message in destroyed)
+
+        for (added, removed), group in groups.items():
+            try:
+                self.store(uidRanges(m.getUID() for m in group),
+                    added, removed)
+                done(group)
+            except IOError as e:
+                failed.extend((message, e) for message in group)
+        self.metrics.count("driver.%s.written"% self.name, len(written))
+        self.metrics.count("driver.%s.failed"% self.name, len(failed))
+        return written, failed
+
+
+class ModseqDriver(Driver):
+    """Fake a driver supporting CONDSTORE (RFC 7162).
+
+    Each change of a message gives it the next modification sequence
+    (modseq) of the mailbox. Changes must go through the driver methods.
+    The modseqs returned to our own writes are collected like a client
+    would collect the MODSEQ of the STORE responses. Expunges are logged
+    for the VANISHED responses of QRESYNC."""
+
+    CONDSTORE = True
+
+    def __init__(self, name, *args, **kw):
+        self.modseq = 0 # Highest modseq of the mailbox.
+        self.modseqs = {} # UID -> modseq of the last change.
+        self.changeLog = [] # (modseq, uid) in modseq order, may be stale.
+        self.ownModseqs = [] # Modseqs given to our writes.
+        self.vanished = [] # (modseq, uid) of the expunges in modseq order.
+        super(ModseqDriver, self).__init__(name, *args, **kw)
+
+    def _changed(self, uid):
+        self.modseq += 1
+        self.modseqs[uid] = self.modseq
+        self.changeLog.append((self.modseq, uid))
+        if len(self.changeLog) > 2 * len(self.modseqs) + 1024:
+            self.changeLog = sorted((modseq, uid)
+                for uid, modseq in self.modseqs.items())
+        return self.modseq
+
+    def _expunged(self, uid):
+        self.modseq += 1
+        del self.modseqs[uid]
+        self.vanished.append((self.modseq, uid))
+        return self.modseq
+
+    def append(self, message):
+        super(ModseqDriver, self).append(message)
+        self.ownModseqs.append(self._changed(message.getUID()))
+
+    def expunge(self, ranges):
+        uids = [uid for first, last in ranges
+            for uid in range(first, last + 1) if uid in self.data]
+        super(ModseqDriver, self).expunge(ranges)
+        for uid in uids:
+            self.ownModseqs.append(self._expunged(uid))
+
+    def fakeChange(self, message):
+        super(ModseqDriver, self).fakeChange(message)
+        self._changed(message.uid)
+
+    def fakeDelete(self, uid):
+        super(ModseqDriver, self).fakeDelete(uid)
+        self._expunged(uid)
+
+    def fetchModseqs(self, uids):
+        """Return the modseqs of these UIDs by UID, like a FETCH of MODSEQ."""
+
+        with self.connection():
+            return {uid: self.modseqs[uid] for uid in uids
+                if uid in self.modseqs}
+
+    def highestModseq(self):
+        with self.connection():
+            return self.modseq
+
+    def popOwnModseqs(self):
+        ownModseqs, self.ownModseqs = self.ownModseqs, []
+        return ownModseqs
+
+    def searchChangedSince(self, modseq, fields=FULL):
+        """Iterate over the messages changed after modseq, like a FETCH with
+        the CHANGEDSINCE modifier. Cost is proportional to the changes."""
+
+        with self.connection():
+            start = bisect_right(self.changeLog, modseq, key=itemgetter(0))
+            for changeModseq, uid in self.changeLog[start:]:
+                if self.modseqs.get(uid) == changeModseq and uid in self.data:
+                    yield self._record(self.data[uid], fields)
+
+    def searchVanishedSince(self, modseq):
+        """Return the UIDs expunged after modseq, like the VANISHED
+        responses of QRESYNC. A UID appended again since is not gone."""
+
+        with self.connection():
+            start = bisect_right(self.vanished, modseq, key=itemgetter(0))
+            return [uid for _, uid in self.vanished[start:]
+                if uid not in self.data]
+
+    def store(self, ranges, added, removed):
+        super(ModseqDriver, self).store(ranges, added, removed)
+        for first, last in ranges:
+            for uid in range(first, last + 1):
+                if uid in self.data:
+                    self.ownModseqs.append(self._changed(uid))
+
+    def update(self, message):
+        super(ModseqDriver, self).update(message)
+        if message.destroyed is False:
+            self.ownModseqs.append(self._changed(message.getUID()))
+
+
+class RetryQueue(object):
+    """Failed writes waiting to be replayed, by driver name and UID.
+
+    Only the UIDs are queued: when replayed, the changes are learned again
+    from the other side since they might have changed. Each failure of a
+    UID doubles its delay before the next attempt, from backoff up to
+    maxBackoff seconds.
+
+    With path, the queue is saved in this file after each change so that
+    failed writes survive a restart."""
+
+    def __init__(self, path=None, backoff=1.0, maxBackoff=300.0,
+            clock=time):
+        self.path = path
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.clock = clock
+        self.entries = {} # (name, uid) -> (attempts, due time).
+        self.lock = threading.Lock() # Both sides are written concurrently.
+        if path is not None and os.path.exists(path):
+            with open(path) as fd:
+                for line in fd:
+                    name, uid, attempts, due = line.split()
+                    self.entries[name, int(uid)] = (int(attempts), float(due))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def due(self, name):
+        """Return the UIDs of the writes on driver name to replay now."""
+
+        now = self.clock()
+        with self.lock:
+            return sorted(uid for (entryName, uid), (_, due)
+                in self.entries.items() if entryName == name and due <= now)
+
+    def discard(self, name, uids):
+        with self.lock:
+            changed = self._discard(name, uids)
+            if changed:
+                self.save()
+
+    def _discard(self, name, uids):
+        entries = self.entries
+        changed = False
+        for uid in uids:
+            if entries.pop((name, uid), None) is not None:
+                changed = True
+        return changed
+
+    def save(self):
+        if self.path is None:
+            return
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as fd:
+            for (name, uid), (attempts, due) in sorted(self.entries.items()):
+                fd.write("%s %i %i %f\n"% (name, uid, attempts, due))
+        os.replace(tmpPath, self.path)
+
+    def update(self, name, writtenMessages, failedMessages):
+        """Drop the written UIDs and schedule the failed ones again."""
+
+        with self.lock:
+            changed = False
+            if self.entries:
+                changed = self._discard(name,
+                    (message.uid for message in writtenMessages))
+            now = self.clock()
+            for message, _ in failedMessages:
+                attempts = self.entries.get((name, message.uid), (0, 0))[0]
+                delay = min(self.backoff * 2 ** attempts, self.maxBackoff)
+                self.entries[name, message.uid] = (attempts + 1, now + delay)
+                changed = True
+            if changed:
+                self.save()
 
 
 class StateController(object):
@@ -232,78 +2050,866 @@ class StateController(object):
         - their state backend.
     """
 
-    def __init__(self, driver, state):
+    def __init__(self, driver, state, columnar=False, metrics=None):
         self.driver = driver # The driver we own.
         self.state = state
+        self.columnar = columnar # Batch diff on flag columns.
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.driver.metrics = self.metrics
+        self.discoveredModseq = None # Highest modseq at last getChanges().
+        self.fields = FLAGS # What getChanges() requests to the driver.
+        self.budget = None # ByteBudget when the new bodies are streamed.
+        self.seenTombstones = set() # Tombstones still in our driver.
+        self.pool = None # Process pool diffing the shards of the columns.
+        self.shards = 1
+        self.failedMessages = [] # Failed writes of last writeDriver().
+        self.retries = None # RetryQueue of the failed writes.
+        self._resetWalked()
+
+    def commitModseq(self, complete, uids=()):
+        """Remember up to which modseq our driver is in sync with the state.
+
+        complete tells whether all our changes were written to the other
+        side. If not, keep the previous modseq so that they are found again.
+        Our own writes are skipped when the modseqs given since discovery
+        are all ours.
+
+        uids are the UIDs synced by the pass. The modseq is held before
+        those of our messages still differing from the state, a UID new on
+        both sides or a failed write for example, so that they are found
+        again."""
+
+        if self.driver.CONDSTORE is False or self.discoveredModseq is None:
+            return
+        ownModseqs = self.driver.popOwnModseqs()
+        if not complete:
+            return
+        modseq = self.discoveredModseq
+        highest = self.driver.highestModseq()
+        if highest - modseq == len(ownModseqs) and \
+                all(ownModseq > modseq for ownModseq in ownModseqs):
+            modseq = highest
+        unsettled = self.unsettledUIDs(uids)
+        if unsettled:
+            modseq = min(modseq,
+                min(self.driver.fetchModseqs(unsettled).values()) - 1)
+        self.state.setSyncedModseq(self.driver.name, modseq)
+        self.discoveredModseq = None
+
+    def unsettledUIDs(self, uids):
+        """Return the UIDs of our messages whose flags differ from the state.
+        The tombstoned UIDs are not messages."""
+
+        messages = self.driver.fetch(uids, FLAGS)
+        records = self.state.view()
+        tombstones = self.state.getTombstones()
+        unsettled = []
+        for uid, message in messages.items():
+            record = records.get(uid)
+            if uid not in tombstones and (record is None or
+                    record.flagBits != message.flagBits):
+                unsettled.append(uid)
+        return unsettled
+
+    def recordState(self, writtenMessages):
+        """Record the messages successfully written by our driver."""
+
+        with self.metrics.timer("state.%s"% self.driver.name):
+            self.state.updateBatch(writtenMessages)
+        self.metrics.count("state.%s.records"% self.driver.name,
+            len(writtenMessages))
 
     def update(self, theirMessages):
         """Update this side with the messages from the other side."""
 
-        for theirMessage in theirMessages.values():
-            try:
-                self.driver.update(theirMessage)
-                self.state.update(theirMessage) # Would be async.
-            except IOError as e:
-                print("Write error on %s failed: %s"% (self.driver.name, e))
+        self.recordState(self.writeDriver(theirMessages))
+
+    def fetchRestored(self, changes):
+        """Fetch the bodies of the merged messages to create again in the
+        other side. The messages expunged since are dropped."""
 
-    #FIXME: we are lying around. The real search() should return full
-    # messages or have parameter to set what we request exactly.
-    # For the sync we need to know what was changed.
+        messages = self.driver.fetch(changes.restored, FULL)
+        for uid in changes.restored:
+            message = messages.get(uid)
+            if message is None:
+                changes.dropped.add(uid)
+            else:
+                changes.merged[uid].body = message.body
+
+    def readBody(self, uid):
+        """Stream the body of our message within the budget."""
+
+        chunkSize = min(CHUNK_SIZE, self.budget.limit)
+        self.metrics.count("streamed.%s"% self.driver.name)
+        return self.budget.stream(self.driver.readBody(uid, chunkSize),
+            chunkSize)
+
+    def writeDriver(self, theirMessages, onWritten=None, bodies=None):
+        """Update our driver only. Return the messages successfully written
+        so that they can be recorded in the state with recordState()."""
+
+        with self.metrics.timer("update.%s"% self.driver.name):
+            writtenMessages, failed = self.driver.updateBatch(
+                list(theirMessages.values()), onWritten, bodies)
+        self.failedMessages = failed
+        for theirMessage, e in failed:
+            log("Write error on %s failed: %s", self.driver.name, e,
+                level=WARNING)
+        if self.retries is not None:
+            self.retries.update(self.driver.name, writtenMessages, failed)
+        return writtenMessages
+
+    # For the sync we need to know what was changed: search() is asked for
+    # the flags only and the new messages are fetched in full afterwards.
     def getChanges(self):
         """Explore our messages. Only return changes since previous sync."""
 
-        changedMessages = Messages() # Collection of new, deleted and updated messages.
-        messages = self.driver.search() # Would be async.
-        stateMessages = self.state.search() # Would be async.
+        with self.metrics.timer("getChanges.%s"% self.driver.name):
+            tombstones = self.state.getTombstones()
+            self.seenTombstones = set(self.driver.fetch(tombstones, UID))
+            if self.driver.CONDSTORE is True:
+                # Only look at the messages changed since last sync.
+                self.discoveredModseq = self.driver.highestModseq()
+                modseq = self.state.getSyncedModseq(self.driver.name)
+                changedMessages = self.scanChanges(
+                    self.driver.searchChangedSince(modseq, self.fields),
+                    self.driver.searchVanishedSince(modseq))
+            elif self.driver.digests is not None and \
+                    self.state.digests is not None:
+                changedMessages = self.getChangesDigests()
+            elif self.columnar is True or self.pool is not None:
+                changedMessages = self.getChangesColumnar()
+            else:
+                changedMessages = self.scanChanges(
+                    self.driver.search(self.fields)) # Would be async.
+        self.metrics.count("changes.%s"% self.driver.name,
+            len(changedMessages))
+        return changedMessages
 
-        for uid, message in messages.items():
+    def getChangesOf(self, uids):
+        """Same as getChanges() for these UIDs only."""
+
+        with self.metrics.timer("getChanges.%s"% self.driver.name):
+            changedMessages = self.scanUIDs(uids)
+        self.metrics.count("changes.%s"% self.driver.name,
+            len(changedMessages))
+        return changedMessages
+
+    def getChangesDigests(self):
+        """Same as getChanges() but only look at the UID ranges whose digests
+        differ between our driver and the state."""
+
+        ranges = self.driver.digests.diff(self.state.digests)
+        self.metrics.count("digests.%s.ranges"% self.driver.name, len(ranges))
+        return self.scanUIDs([uid for first, last in ranges
+            for uid in range(first, last + 1)])
+
+    def scanUIDs(self, uids):
+        """Compare our messages of these UIDs to the state. The UIDs
+        missing in our driver are deleted."""
+
+        messages = self.driver.fetch(uids, self.fields)
+        return self.scanChanges(messages.values(),
+            [uid for uid in uids if uid not in messages])
+
+    def scanChanges(self, messages, vanished=None):
+        """Compare our messages to the state, one by one.
+
+        Without vanished, messages are all our messages and the deleted
+        messages are the UIDs of the state we don't have. Otherwise, vanished
+        are the UIDs expunged since previous sync."""
+
+        changedMessages = Messages() # Collection of new, deleted and updated messages.
+        stateMessages = self.state.view() # Would be async.
+        tombstones = self.state.getTombstones()
+        uids = set()
+        known = 0 # UIDs found in the state.
+        newUIDs = []
+
+        for message in messages:
+            uid = message.uid
+            uids.add(uid)
             if uid in stateMessages:
+                known += 1
                 stateMessage = stateMessages[uid]
                 if not message.identical(stateMessage):
                     message.learnChanges(stateMessage)
                     changedMessages.add(message)
-            else:
+            elif uid not in tombstones:
                 # Missing in the other side.
-                message.markUnkown()
-                changedMessages.add(message)
+                newUIDs.append(uid)
+                changedMessages.data[uid] = None # Keep the order.
+        self.metrics.count("scanned.%s"% self.driver.name, len(uids))
+        self._addNewMessages(changedMessages, newUIDs)
+
+        if vanished is not None:
+            deletedUIDs = [uid for uid in vanished if uid in stateMessages]
+        elif known < len(stateMessages):
+            # Some UIDs of the state are missing.
+            deletedUIDs = sorted(stateMessages.keys() - uids)
+        else:
+            deletedUIDs = []
+        self._addDeletedMessages(changedMessages, deletedUIDs)
+
+        return changedMessages
 
-        # TODO: mark message as destroyed from real repository.
-        # for stateMessage in stateMessages:
-            # if stateMessage not in messages:
-                # changedMessages.add(message)
+    def _addDeletedMessages(self, changedMessages, deletedUIDs):
+        for uid in deletedUIDs:
+            message = Message(uid)
+            message.markDestroyed()
+            changedMessages.add(message)
+        self.metrics.count("deleted.%s"% self.driver.name, len(deletedUIDs))
+
+    def _addNewMessages(self, changedMessages, newUIDs):
+        """Fetch the new messages in full: their body is required to create
+        them in the other side. When streaming, the bodies are read later
+        with readBody()."""
+
+        messages = self.driver.fetch(newUIDs,
+            FULL if self.budget is None else self.fields)
+        for uid in newUIDs:
+            message = messages.get(uid)
+            if message is None:
+                # Expunged since the search.
+                del changedMessages.data[uid]
+                continue
+            message.markUnkown()
+            changedMessages.add(message)
+
+    def _resetWalked(self):
+        self.walkedMessages = Messages() # Changes walked by walk().
+        self.walkedNewUIDs = []
+        self.walkedDeletedUIDs = []
+        self.walkedCount = 0
+
+    def popWalked(self):
+        """Return the changes walked since previous call, like
+        getChanges()."""
+
+        changedMessages = self.walkedMessages
+        self.metrics.count("scanned.%s"% self.driver.name, self.walkedCount)
+        self._addNewMessages(changedMessages, self.walkedNewUIDs)
+        self._addDeletedMessages(changedMessages, self.walkedDeletedUIDs)
+        self.metrics.count("changes.%s"% self.driver.name,
+            len(changedMessages))
+        self._resetWalked()
+        return changedMessages
+
+    def walk(self, uid, message, stateMessage, tombstones):
+        """Learn the change of a UID walked in UID order in lockstep with the
+        state, see mergeJoin(). message or stateMessage is None when missing.
+        Return 1 if a change was learned, 0 otherwise."""
+
+        if message is None:
+            if stateMessage is None:
+                return 0
+            self.walkedDeletedUIDs.append(uid)
+            return 1
+        self.walkedCount += 1
+        if stateMessage is None:
+            if uid in tombstones:
+                return 0
+            # Missing in the other side.
+            self.walkedNewUIDs.append(uid)
+            self.walkedMessages.data[uid] = None # Keep the order.
+            return 1
+        if message.identical(stateMessage):
+            return 0
+        message.learnChanges(stateMessage)
+        self.walkedMessages.add(message)
+        return 1
+
+    def getChangesColumnar(self, useNumpy=True):
+        """Same as getChanges() but diff the flags in batch.
+
+        Only the new and changed messages are visited in Python."""
+
+        changedMessages = Messages()
+        messages = self.driver.search(FLAGS) # Would be async.
+        stateMessages = self.state.search(FLAGS) # Would be async.
+        tombstones = self.state.getTombstones()
+
+        columns = FlagColumns(messages, useNumpy=useNumpy)
+        stateColumns = FlagColumns(stateMessages, sort=True, useNumpy=useNumpy)
+        if self.pool is not None:
+            uids, added, removed, unknown, missing = columns.diffSharded(
+                stateColumns, self.pool, self.shards)
+        else:
+            uids, added, removed, unknown = columns.diff(stateColumns)
+            missing = columns.missing(stateColumns)
+        changed = self.driver.fetch((uid for uid, new in zip(uids, unknown)
+            if new is False), self.fields)
+        newUIDs = []
+        for uid, addedBits, removedBits, new in zip(uids, added, removed,
+                unknown):
+            if new is True:
+                if uid in tombstones:
+                    continue
+                # Missing in the other side.
+                newUIDs.append(uid)
+                changedMessages.data[uid] = None # Keep the order.
+            else:
+                message = changed[uid]
+                message.learnChangeBits(addedBits, removedBits)
+                changedMessages.add(message)
+        self._addNewMessages(changedMessages, newUIDs)
+        self._addDeletedMessages(changedMessages, missing)
 
         return changedMessages
 
 
+class Runner(object):
+    """Run independent calls one after the other.
+
+    Runners return the results in the order of the calls whatever the order
+    of completion, so that the engine is deterministic."""
+
+    def close(self):
+        pass
+
+    def run(self, *calls):
+        return [call() for call in calls]
+
+
+class ThreadRunner(Runner):
+    """Run independent calls concurrently in a thread pool."""
+
+    def __init__(self, workers=2):
+        self.executor = ThreadPoolExecutor(workers)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def run(self, *calls):
+        futures = [self.executor.submit(call) for call in calls]
+        return [future.result() for future in futures]
+
+
+class AsyncioRunner(Runner):
+    """Run independent calls concurrently in an asyncio event loop.
+
+    Coroutine functions are awaited, blocking calls run in threads."""
+
+    async def _call(self, call):
+        if inspect.iscoroutinefunction(call):
+            return await call()
+        return await asyncio.to_thread(call)
+
+    async def _gather(self, calls):
+        return await asyncio.gather(*[self._call(call) for call in calls])
+
+    def run(self, *calls):
+        return asyncio.run(self._gather(calls))
+
+
+class Worker(object):
+    """Run the calls sent to our inbox one after the other in a thread, like
+    an actor. Workers talk to each other by sending calls.
+
+    The inbox is bounded: send() blocks while it is full so that a slow
+    worker throttles the workers sending to it instead of piling up their
+    messages. The metrics are the timer worker.<name>.busy of the calls, the
+    timer worker.<name>.blocked of the sends waiting for room and the gauge
+    queue.<name> of the depth of the inbox.
+
+    After an error, the next calls are dropped and join() raises the
+    error."""
+
+    def __init__(self, name, queueSize, metrics):
+        self.name = name
+        self.metrics = metrics
+        self.error = None
+        self.inbox = queue.Queue(queueSize)
+        self.thread = threading.Thread(target=self._work, name=name,
+            daemon=True)
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            call = self.inbox.get()
+            if call is None:
+                return
+            self.metrics.gauge("queue.%s"% self.name, self.inbox.qsize())
+            if self.error is not None:
+                continue # Dropped.
+            try:
+                with self.metrics.timer("worker.%s.busy"% self.name):
+                    call()
+            except Exception as e:
+                self.error = e
+
+    def join(self):
+        """Stop once the calls already sent are done."""
+
+        self.inbox.put(None)
+        self.thread.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def send(self, call):
+        try:
+            self.inbox.put_nowait(call)
+        except queue.Full:
+            with self.metrics.timer("worker.%s.blocked"% self.name):
+                self.inbox.put(call)
+        self.metrics.gauge("queue.%s"% self.name, self.inbox.qsize())
+
+
 class Engine(object):
-    """The engine."""
-    def __init__(self, left, right):
-        state = StateStorage() # Would be an emitter.
+    """The engine.
+
+    Both sides are explored and then updated through the runner. The drivers
+    are written first and the state is recorded afterwards, left then right,
+    so that all runners give the same result.
+
+    With writeBehind, the state is recorded in background. The writes of
+    both sides may not commute, a UID new on both sides for example: the
+    records of left are queued as soon as each request succeeds and those
+    of right once both drivers are written, so that the state is the same
+    as without writeBehind.
+
+    With streamBudget, the bodies of the new messages are not fetched with
+    the changes but streamed from one driver to the other when written, with
+    at most streamBudget bytes in flight.
+
+    With shards, the flag columns are diffed by UID ranges in a pool of
+    processes. Both sides share the pool.
+
+    With retries, the failed writes are queued in this RetryQueue and
+    replayed alone by retry(). The modseqs are then committed despite the
+    failures, before the messages still differing from the state.
+
+    With batchSize, both drivers and the state are walked in UID order in
+    lockstep and the changes are synced by batches of about batchSize
+    messages while walking: the memory is bounded by the batches, not by
+    the mailboxes. The walk replaces the other ways to look for the
+    changes: combining batchSize with columnar, digests, shards or CONDSTORE
+    drivers raises ValueError.
+
+    With digests, both drivers and the state maintain the RangeDigests of
+    their flags and only the UID ranges whose digests differ from the state
+    are scanned. They must be changed through their methods only.
+
+    With queueSize, which requires batchSize, the batches are synced by
+    workers while walking: one merges the batches, one writes each driver
+    and one records the state. Their inboxes hold at most queueSize messages
+    so that a slow driver throttles the walk: about queueSize batches per
+    worker are in memory at most."""
+
+    def __init__(self, left, right, columnar=False, state=None, runner=None,
+            writeBehind=False, profile=(), streamBudget=None, shards=1,
+            policy=None, retries=None, batchSize=None, digests=False,
+            queueSize=None):
+        if batchSize is not None:
+            unsupported = [name for name, enabled in (
+                ("columnar", columnar), ("digests", digests),
+                ("shards", shards > 1),
+                ("CONDSTORE", left.CONDSTORE or right.CONDSTORE))
+                if enabled]
+            if unsupported:
+                raise ValueError("batchSize cannot be combined with %s"%
+                    ", ".join(unsupported))
+        elif queueSize is not None:
+            raise ValueError("queueSize requires batchSize")
+        if state is None:
+            state = StateStorage() # Would be an emitter.
+        if writeBehind is True:
+            state = WriteBehindState(state)
+        self.writeBehind = writeBehind
+        # Metrics of the last run. Timers in profile are profiled.
+        self.metrics = Metrics(profile)
         # Add the state controller to the chain of controllers of the drivers.
         # Real driver might need API to work on chained controllers.
-        self.left = StateController(left, state)
-        self.right = StateController(right, state)
+        self.left = StateController(left, state, columnar, self.metrics)
+        self.right = StateController(right, state, columnar, self.metrics)
+        self.merger = Merge(policy, self.metrics)
+        self.runner = runner if runner is not None else Runner()
+        if streamBudget is not None:
+            # Shared by both directions.
+            self.left.budget = self.right.budget = ByteBudget(streamBudget)
+        self.pool = None
+        if shards > 1:
+            self.pool = ProcessPoolExecutor(shards)
+            for controller in (self.left, self.right):
+                controller.pool, controller.shards = self.pool, shards
+        self.retries = retries
+        self.left.retries = self.right.retries = retries
+        self.batchSize = batchSize
+        self.queueSize = queueSize
+        self.workers = {} # Name -> Worker syncing the batches.
+        if digests is True:
+            for storage in (left, right, state):
+                storage.enableDigests()
+
+    def close(self):
+        self.runner.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+        if hasattr(self.left.state, 'close'):
+            self.left.state.close()
 
     def debug(self, title):
-        log(title)
-        log("left:  %s"% self.left.driver.data)
-        log("rght:  %s"% self.right.driver.data)
-        log("state: %s"% self.left.state.data) # leftState == rightState
-        log("")
+        """Dump both sides and the state. Costly on large mailboxes."""
+
+        if logLevel > DEBUG:
+            return
+        log(title, level=DEBUG)
+        log("left:  %s", self.left.driver.data, level=DEBUG)
+        log("rght:  %s", self.right.driver.data, level=DEBUG)
+        # leftState == rightState
+        log("state: %s", self.left.state.data, level=DEBUG)
+        tombstones = self.left.state.getTombstones()
+        if tombstones:
+            log("tombstones: %s", sorted(tombstones), level=DEBUG)
+        log("", level=DEBUG)
 
     def run(self):
-        leftMessages = self.left.getChanges() # Would be async.
-        rightMessages = self.right.getChanges() # Would be async.
+        """Run a sync pass. Return the snapshot of the metrics of the pass."""
+
+        self.metrics.reset()
+        with self.metrics.timer("run"):
+            self._run()
+        return self.metrics.snapshot()
+
+    def retry(self):
+        """Replay the failed writes which are due, without scanning the
+        mailboxes. Return the snapshot of the metrics of the pass."""
+
+        self.metrics.reset()
+        with self.metrics.timer("retry"):
+            self._retry()
+        return self.metrics.snapshot()
+
+    def _retry(self):
+        # Writes on left are the changes of right, and vice versa.
+        leftUIDs = self.retries.due(self.left.driver.name)
+        rightUIDs = self.retries.due(self.right.driver.name)
+        self.metrics.count("retried", len(leftUIDs) + len(rightUIDs))
+        if not leftUIDs and not rightUIDs:
+            return
+        leftMessages, rightMessages = self.runner.run(
+            partial(self.left.getChangesOf, rightUIDs),
+            partial(self.right.getChangesOf, leftUIDs))
+        leftChanges, rightChanges = self._sync(leftMessages, rightMessages)
+        # Nothing left to write: already in sync.
+        self.retries.discard(self.left.driver.name,
+            [uid for uid in leftUIDs if uid not in rightChanges])
+        self.retries.discard(self.right.driver.name,
+            [uid for uid in rightUIDs if uid not in leftChanges])
+
+    def _run(self):
+        if self.batchSize is not None:
+            self._runLockstep()
+            return
+        leftMessages, rightMessages = self.runner.run(
+            self.left.getChanges, self.right.getChanges)
+        # Tombstones are useless once in none of the drivers.
+        self.metrics.count("tombstones.purged",
+            self.left.state.purgeTombstones(
+                self.left.seenTombstones | self.right.seenTombstones))
+        self._sync(leftMessages, rightMessages)
+
+        # Our changes are in sync once written to the other side, or queued
+        # for retry.
+        queued = self.retries is not None
+        uids = set(leftMessages.data).union(rightMessages.data)
+        self.left.commitModseq(queued or not self.right.failedMessages, uids)
+        self.right.commitModseq(queued or not self.left.failedMessages, uids)
+
+    def _runLockstep(self):
+        left, right = self.left, self.right
+        tombstones = left.state.getTombstones()
+        for controller in (left, right):
+            controller.seenTombstones = set(
+                controller.driver.fetch(tombstones, UID))
+        self.metrics.count("tombstones.purged", left.state.purgeTombstones(
+            left.seenTombstones | right.seenTombstones))
+
+        sync = self._sync
+        if self.queueSize is not None:
+            self._startWorkers()
+            sync = self._sendBatch
+        try:
+            # The writes of a batch only touch the UIDs already walked.
+            rows = mergeJoin(left.driver.searchSorted(left.fields),
+                left.state.searchSorted(),
+                right.driver.searchSorted(right.fields))
+            pending = 0
+            for uid, leftMessage, stateMessage, rightMessage in rows:
+                pending += left.walk(uid, leftMessage, stateMessage,
+                    tombstones)
+                pending += right.walk(uid, rightMessage, stateMessage,
+                    tombstones)
+                if pending >= self.batchSize:
+                    sync(left.popWalked(), right.popWalked())
+                    pending = 0
+            sync(left.popWalked(), right.popWalked())
+        finally:
+            try:
+                self._stopWorkers()
+            finally:
+                # The records written behind are done when run() returns.
+                left.state.flush()
+
+    def _startWorkers(self):
+        for name in ("merge", "left", "right", "state"): # Upstream first.
+            self.workers[name] = Worker(name, self.queueSize, self.metrics)
+
+    def _stopWorkers(self):
+        """Stop the workers once their calls are done, upstream first. Raise
+        the first error of the workers."""
+
+        error = None
+        for worker in self.workers.values():
+            try:
+                worker.join()
+            except Exception as e:
+                if error is None:
+                    error = e
+        self.workers = {}
+        if error is not None:
+            raise error
+
+    def _sendBatch(self, leftMessages, rightMessages):
+        self.workers["merge"].send(
+            partial(self._mergeBatch, leftMessages, rightMessages))
+
+    def _mergeBatch(self, leftMessages, rightMessages):
+        """Run by the merge worker: send the merged changes to the workers
+        of the drivers and of the state."""
+
+        leftBodies, rightBodies = self._bodies()
+        leftChanges, rightChanges, stateChanges = self._merge(leftMessages,
+            rightMessages)
+        leftWritten, rightWritten = Future(), Future()
+        # Both sides are written concurrently.
+        self.workers["left"].send(partial(self._writeBatch, self.left,
+            rightChanges, rightBodies, leftWritten))
+        self.workers["right"].send(partial(self._writeBatch, self.right,
+            leftChanges, leftBodies, rightWritten))
+        self.workers["state"].send(partial(self._recordBatch, stateChanges,
+            leftWritten, rightWritten))
+
+    def _writeBatch(self, controller, theirMessages, bodies, written):
+        """Run by the worker of the driver of controller. The messages
+        written are the result of the future written."""
+
+        try:
+            written.set_result(controller.writeDriver(theirMessages, None,
+                bodies))
+        except Exception as e:
+            written.set_exception(e)
+            raise
+
+    def _recordBatch(self, stateChanges, leftWritten, rightWritten):
+        """Run by the state worker. The writes of both sides of a batch may
+        not commute: they are recorded left then right, like _sync()."""
+
+        if stateChanges:
+            self._recordMerged(stateChanges)
+        self.left.recordState(leftWritten.result())
+        self.right.recordState(rightWritten.result())
+
+    def _bodies(self):
+        """Return the readers of the bodies of left and right, if streamed."""
+
+        if self.left.budget is None:
+            return None, None
+        return self.left.readBody, self.right.readBody
+
+    def _merge(self, leftMessages, rightMessages):
+        """Merge the changes. Return the changes to write by left and right
+        and the records of the changes already in both drivers."""
+
+        with self.metrics.timer("merge"):
+            leftChanges, rightChanges, stateChanges = self.merger.merge(
+                leftMessages, rightMessages)
+        for controller, changes in ((self.left, leftChanges),
+                (self.right, rightChanges)):
+            if changes.restored and controller.budget is None:
+                controller.fetchRestored(changes)
+
+        if logLevel <= INFO:
+            log("\n## Changes found:")
+            log("- from left: %s", list(leftMessages.data.keys()))
+            log("- from rght: %s", list(rightMessages.data.keys()))
+        return leftChanges, rightChanges, stateChanges
+
+    def _recordMerged(self, stateChanges):
+        with self.metrics.timer("state"):
+            self.left.state.updateBatch(list(stateChanges.values()))
+
+    def _sync(self, leftMessages, rightMessages):
+        """Merge the changes, write them and record the state. Return the
+        merged changes of left and right."""
+
+        leftBodies, rightBodies = self._bodies()
+        leftChanges, rightChanges, stateChanges = self._merge(leftMessages,
+            rightMessages)
+
+        # Already in both drivers.
+        if stateChanges:
+            self._recordMerged(stateChanges)
+        leftMessages, rightMessages = leftChanges, rightChanges
+
+        if self.writeBehind is True:
+            rightWritten = []
+            try:
+                self.runner.run(
+                    partial(self.left.writeDriver, rightMessages,
+                        self.left.recordState, rightBodies),
+                    partial(self.right.writeDriver, leftMessages,
+                        rightWritten.extend, leftBodies))
+            finally:
+                # Left then right, like below.
+                self.right.recordState(rightWritten)
+                self.left.state.flush()
+        else:
+            leftWritten, rightWritten = self.runner.run(
+                partial(self.left.writeDriver, rightMessages, None,
+                    rightBodies),
+                partial(self.right.writeDriver, leftMessages, None,
+                    leftBodies))
+            self.left.recordState(leftWritten)
+            self.right.recordState(rightWritten)
+        return leftMessages, rightMessages
 
-        # Merge the changes.
-        leftMessages.merge(rightMessages)
 
-        log("\n## Changes found:")
-        log("- from left: %s"% list(leftMessages.data.keys()))
-        log("- from rght: %s"% list(rightMessages.data.keys()))
+def syncFolder(factory):
+    """Run a sync pass with a new engine. Used by the worker processes."""
 
-        self.left.update(rightMessages)
-        self.right.update(leftMessages)
+    engine = factory()
+    try:
+        return engine.run()
+    finally:
+        engine.close()
+
+
+class Folder(object):
+    """A folder pair of an account, synced by its own engine."""
+
+    def __init__(self, account, name, factory):
+        self.account = account
+        self.name = name
+        self.factory = factory # Return the engine of the folder.
+        self.engine = None # Kept between the syncs in threads.
+        self.activity = 0.0 # Changes found recently, decaying.
+        self.metrics = None # Snapshot of the last sync.
+        self.error = None # Error of the last sync.
+
+    def __repr__(self):
+        return "%s/%s"% (self.account, self.name)
+
+    def sync(self):
+        if self.engine is None:
+            self.engine = self.factory()
+        return self.engine.run()
+
+
+class Scheduler(object):
+    """Sync many folders, each with its own engine.
+
+    The folders are synced by a pool of workers. At most accountLimit
+    folders of the same account are synced at once, like a limit of
+    connections per account. The folders with the most changes at the
+    previous syncs go first.
+
+    The engines and their states share nothing so the workers never wait
+    for each other. With threads, the engine of a folder is built once by
+    its factory and kept. With processes, the factory is sent to a worker
+    and called at each sync: it must be picklable and the engine must open
+    persistent storages."""
+
+    ACTIVITY_DECAY = 0.5 # Weight of the previous activity of a folder.
+
+    def __init__(self, workers=4, accountLimit=2, processes=False):
+        self.workers = workers
+        self.accountLimit = accountLimit
+        self.processes = processes
+        self.folders = []
+        if processes is True:
+            self.executor = ProcessPoolExecutor(workers)
+        else:
+            self.executor = ThreadPoolExecutor(workers)
+
+    def _submit(self, folder):
+        if self.processes is True:
+            return self.executor.submit(syncFolder, folder.factory)
+        return self.executor.submit(folder.sync)
+
+    def add(self, account, name, factory):
+        folder = Folder(account, name, factory)
+        self.folders.append(folder)
+        return folder
+
+    def close(self):
+        self.executor.shutdown()
+        for folder in self.folders:
+            if folder.engine is not None:
+                folder.engine.close()
+
+    def report(self, seconds, order):
+        """Return the aggregated metrics of a sync of all the folders."""
+
+        totals = {'changes': 0, 'scanned': 0, 'written': 0}
+        for folder in self.folders:
+            if folder.error is not None or folder.metrics is None:
+                continue
+            for name, value in folder.metrics['counters'].items():
+                kind = name.split('.')[0]
+                if kind == 'driver':
+                    kind = name.split('.')[-1]
+                if kind in totals:
+                    totals[kind] += value
+        report = {
+            'seconds': seconds,
+            'folders': len(self.folders),
+            'errors': sum(1 for f in self.folders if f.error is not None),
+            'order': [repr(folder) for folder in order],
+            }
+        report.update(totals)
+        for kind in totals:
+            report['%sPerSecond'% kind] = \
+                totals[kind] / seconds if seconds > 0 else 0.0
+        return report
+
+    def run(self):
+        """Sync all the folders once. Return the report()."""
+
+        start = perf_counter()
+        pending = sorted(self.folders, key=lambda f: -f.activity) # Stable.
+        running = {} # Future -> folder.
+        busy = {} # Account -> number of folders syncing.
+        order = []
+        while pending or running:
+            for folder in list(pending):
+                if len(running) >= self.workers:
+                    break
+                if busy.get(folder.account, 0) >= self.accountLimit:
+                    continue
+                pending.remove(folder)
+                busy[folder.account] = busy.get(folder.account, 0) + 1
+                running[self._submit(folder)] = folder
+                order.append(folder)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder = running.pop(future)
+                busy[folder.account] -= 1
+                try:
+                    folder.metrics = future.result()
+                    folder.error = None
+                except Exception as e:
+                    folder.error = e
+                    log("Sync of %s failed: %s", folder, e, level=WARNING)
+                    continue
+                changes = sum(value for name, value
+                    in folder.metrics['counters'].items()
+                    if name.startswith('changes.'))
+                folder.activity = \
+                    folder.activity * self.ACTIVITY_DECAY + changes
+        return self.report(perf_counter() - start, order)
 
 
 if __name__ == '__main__':
@@ -311,8 +2917,8 @@ if __name__ == '__main__':
     left = Driver("left")  # Fake those data.
     right = Driver("rght") # Fake those data.
 
-    # Start engine.
-    engine = Engine(left, right)
+    # Start engine. Failed writes are replayed as soon as retry() is called.
+    engine = Engine(left, right, retries=RetryQueue(backoff=0))
 
     log("\n# RUN 0")
     engine.debug("## Before RUN 0")
@@ -388,6 +2994,40 @@ if __name__ == '__main__':
     engine.debug("\n## After RUN 7.")
     log("# RUN 7 done\n")
 
+
+    log("\n# RUN 8 (left deletion, new message in right)")
+    m3 = Message(3, "3 body")
+    right.fakeChange(m3)
+    left.fakeDelete(1)
+    engine.debug("## Before RUN 8")
+    engine.run()
+    engine.debug("\n## After RUN 8.")
+    log("# RUN 8 done\n")
+
+    log("\n# RUN 9 (deleted in left, changed in right)")
+    m3.markRead()
+    right.fakeChange(m3)
+    left.fakeDelete(3)
+    engine.debug("## Before RUN 9")
+    engine.run()
+    engine.debug("\n## After RUN 9.")
+    log("# RUN 9 done\n")
+
+    log("\n# RUN 10 (tombstones purged)")
+    engine.run()
+    engine.debug("\n## After RUN 10.")
+    log("# RUN 10 done\n")
+
+    log("\n# RUN 11 (left write error, replayed alone)")
+    m2.markImportant()
+    right.fakeChange(m2)
+    left.FakeDriverWriteError = True
+    engine.debug("## Before RUN 11")
+    engine.run()
+    engine.retry()
+    engine.debug("\n## After RUN 11.")
+    log("# RUN 11 done\n")
+
     #TODO: PASS with changed messages.
 
 
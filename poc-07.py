@@ -3,24 +3,115 @@
 # https://github.com/OfflineIMAP/imapfw/wiki/sync-07
 
 
+import hashlib
 from functools import total_ordering
+from operator import attrgetter
 from collections import UserList
-from copy import deepcopy
+
+
+def fingerprint(body):
+    """Return the hash of the content of a message.
+
+    The content is normalized so that the copies of a message in different
+    stores match: the line endings and the trailing spaces are ignored."""
+
+    if isinstance(body, str):
+        body = body.encode()
+    lines = (line.rstrip() for line in body.splitlines())
+    return hashlib.sha1(b'\n'.join(lines)).hexdigest()
+
+
+class ContentIndex(object):
+    """Index messages by the fingerprint of their content. Messages without
+    a body have no known content: they are never paired."""
+
+    def __init__(self, messages=()):
+        self.messages = {} # Fingerprint -> messages with this content.
+        self.withoutBody = []
+        for message in messages:
+            if message.body is None:
+                self.withoutBody.append(message)
+                continue
+            self.messages.setdefault(fingerprint(message.body), []).append(
+                message)
+
+    def pop(self, message):
+        """Remove and return a message with the same content, and the same
+        UID unless one of both has none. Return None if there is none."""
+
+        if message.body is None:
+            return None
+        candidates = self.messages.get(fingerprint(message.body), [])
+        for i, candidate in enumerate(candidates):
+            if None in (candidate.uid, message.uid) or \
+                    candidate.uid == message.uid:
+                return candidates.pop(i)
+        return None
+
+    def remaining(self):
+        """Iterate over the messages not popped."""
+
+        yield from self.withoutBody
+        for candidates in self.messages.values():
+            yield from candidates
+
+
+def mergeJoin(*iterables):
+    """Walk UID-sorted iterables of messages in lockstep, like a merge join.
+
+    Yield a (uid, message, ...) tuple per UID with a message per iterable,
+    None where the UID is missing. Only the current message of each
+    iterable is held."""
+
+    end = float('inf') # UID of the exhausted iterables.
+    iterators = [iter(iterable) for iterable in iterables]
+    heads = [next(iterator, None) for iterator in iterators]
+    uids = [end if head is None else head.uid for head in heads]
+    indexes = range(len(heads))
+    while True:
+        uid = min(uids)
+        if uid == end:
+            return
+        row = [uid]
+        for i in indexes:
+            if uids[i] == uid:
+                row.append(heads[i])
+                head = heads[i] = next(iterators[i], None)
+                uids[i] = end if head is None else head.uid
+            else:
+                row.append(None)
+        yield tuple(row)
 
 
 @total_ordering
 class Message(object):
-    """Fake the real Message class."""
+    """Fake the real Message class.
+
+    Flags are stored as a bitmask (see FLAGS). Changes are tri-state and are
+    stored as two bitmasks: the flags added and the flags removed. A flag in
+    none of them did not change."""
+
+    __slots__ = ('uid', 'body', 'flagBits', 'addedBits', 'removedBits')
+
+    FLAGS = {'read': 1, 'important': 2}
+    DELETED = 4 # Only a change, never a flag.
 
     def __init__(self, uid=None, body=None):
         self.uid = uid
         self.body = body
-        self.flags = {'read': False, 'important': False}
+        self.flagBits = 0
         # Store what was changed. Flags can be:
-        # - True: addition
-        # - False: deletion
-        # - None: no change
-        self.changes = {'read': None, 'important': None, 'deleted': False}
+        # - in addedBits: addition
+        # - in removedBits: deletion
+        # - in none: no change
+        self.addedBits = 0
+        self.removedBits = 0
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return self.copy()
 
     def __repr__(self):
         return "<Message %s [%s] '%s'>"% (self.uid, self.flags, self.body)
@@ -34,6 +125,40 @@ class Message(object):
     def __lt__(self, other):
         return self.uid < other
 
+    @property
+    def changes(self):
+        changes = {}
+        for flag, bit in self.FLAGS.items():
+            if self.addedBits & bit:
+                changes[flag] = True
+            elif self.removedBits & bit:
+                changes[flag] = False
+            else:
+                changes[flag] = None
+        changes['deleted'] = bool(self.addedBits & self.DELETED)
+        return changes
+
+    @property
+    def flags(self):
+        return {flag: bool(self.flagBits & bit)
+            for flag, bit in self.FLAGS.items()}
+
+    def copy(self):
+        """Return a snapshot of this message.
+
+        All the fields are immutable values: the snapshot shares them, the
+        body included, and only the slots are copied. Storage.update() keeps
+        a snapshot and getChanges() yields snapshots, so no message is in two
+        collections."""
+
+        message = Message.__new__(Message)
+        message.uid = self.uid
+        message.body = self.body
+        message.flagBits = self.flagBits
+        message.addedBits = self.addedBits
+        message.removedBits = self.removedBits
+        return message
+
     def getChanges(self):
         return self.changes
 
@@ -42,45 +167,147 @@ class Message(object):
             return False
         if message.body != self.body:
             return False
-        if message.flags != self.flags:
+        if message.flagBits != self.flagBits:
             return False
 
         return True # Identical
 
     def isImportant(self):
-        return self.flags['important']
+        return bool(self.flagBits & self.FLAGS['important'])
 
     def isRead(self):
-        return self.flags['read']
+        return bool(self.flagBits & self.FLAGS['read'])
 
     def learnChanges(self, stateMessage):
         """Learn what was changed is which way."""
 
-        if self.isImportant() != stateMessage.isImportant():
-            self.changes['important'] = self.isImportant()
-
-        if self.isRead() != stateMessage.isRead():
-            self.changes['read'] = self.isRead()
+        diff = (stateMessage.flagBits ^ self.flagBits) & ~self.DELETED
+        self.addedBits = (self.addedBits & ~diff) | (diff & self.flagBits)
+        self.removedBits = (self.removedBits & ~diff) | (diff & ~self.flagBits)
 
     def markImportant(self):
-        self.flags['important'] = True
+        self.flagBits |= self.FLAGS['important']
 
     def markRead(self):
-        self.flags['read'] = True
+        self.flagBits |= self.FLAGS['read']
 
     def setDeleted(self):
-        self.changes['deleted'] = True
+        self.addedBits |= self.DELETED
 
     def unmarkImportant(self):
-        self.flags['important'] = False
+        self.flagBits &= ~self.FLAGS['important']
 
     def unmarkRead(self):
-        self.flags['read'] = False
+        self.flagBits &= ~self.FLAGS['read']
 
 
 class Messages(UserList):
-    """Enable collections of messages the easy way."""
-    pass #TODO: implement collection comparison.
+    """Enable collections of messages the easy way.
+
+    The list keeps an index of the positions of the messages by UID so that
+    lookups do not have to scan the whole collection. The index is
+    maintained on every change to the list.
+
+    remove() moves the last message to the place of the removed one so that
+    removals cost O(1): the order of the messages is not kept."""
+
+    def __init__(self, initlist=None):
+        super(Messages, self).__init__(initlist)
+        self._index = {} # UID -> positions of the messages with this UID.
+        self._reindex()
+
+    def __contains__(self, message):
+        return getattr(message, 'uid', message) in self._index
+
+    def __setitem__(self, i, message):
+        self.data[i] = message
+        self._reindex()
+
+    def __delitem__(self, i):
+        del self.data[i]
+        self._reindex()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, n):
+        self.data *= n
+        self._reindex()
+        return self
+
+    def _indexed(self, i):
+        self._index.setdefault(self.data[i].uid, []).append(i)
+
+    def _reindex(self):
+        self._index.clear()
+        for i in range(len(self.data)):
+            self._indexed(i)
+
+    def _removeAt(self, i):
+        """Remove the message at position i and move the last message to
+        its place."""
+
+        message = self.data[i]
+        positions = self._index[message.uid]
+        positions.remove(i) # Only long with duplicated UIDs.
+        if not positions:
+            del self._index[message.uid]
+        last = self.data.pop()
+        if i < len(self.data):
+            self.data[i] = last
+            positions = self._index[last.uid]
+            positions[positions.index(len(self.data))] = i
+        return message
+
+    def append(self, message):
+        self.data.append(message)
+        self._indexed(len(self.data) - 1)
+
+    def clear(self):
+        self.data.clear()
+        self._index.clear()
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def get(self, uid, default=None):
+        """Return the message with this UID."""
+
+        positions = self._index.get(uid)
+        if positions is None:
+            return default
+        return self.data[positions[0]]
+
+    def insert(self, i, message):
+        self.data.insert(i, message)
+        self._reindex()
+
+    def pop(self, i=-1):
+        if i in (-1, len(self.data) - 1):
+            return self._removeAt(len(self.data) - 1)
+        message = self.data.pop(i)
+        self._reindex()
+        return message
+
+    def remove(self, message):
+        uid = getattr(message, 'uid', message)
+        positions = self._index.get(uid)
+        if positions is None:
+            raise ValueError("message %s not in messages"% uid)
+        self._removeAt(positions[0])
+
+    def reverse(self):
+        self.data.reverse()
+        self._reindex()
+
+    def sort(self, *args, **kwds):
+        self.data.sort(*args, **kwds)
+        self._reindex()
+
+    def uids(self):
+        return self._index.keys()
 
 
 # Fake any storage. Allows making this PoC more simple.
@@ -88,9 +315,30 @@ class Storage(object):
     def __init__(self, list_messages):
         self.messages = Messages(list_messages) # Fake the real data.
 
+    def assignUIDs(self, assignments):
+        """Set the UIDs of our messages from (message, uid) pairs."""
+
+        for message, uid in assignments:
+            message.uid = uid
+        self.messages._reindex()
+
     def search(self):
         return self.messages
 
+    def searchSorted(self):
+        """Iterate over the messages having a UID, in UID order. See
+        searchWithoutUID() for the others."""
+
+        # Would be streamed in order.
+        return iter(sorted((message for message in self.messages.data
+            if message.uid is not None), key=attrgetter('uid')))
+
+    def searchWithoutUID(self):
+        """Iterate over the new messages not given a UID yet."""
+
+        return (message for message in self.messages.data
+            if message.uid is None)
+
     def update(self, newMessage):
         """Update the storage.
 
@@ -104,20 +352,18 @@ class Storage(object):
         # same goes for removal. Lets say there is m4l but m4r is missing . So
         # what should we do should we remove m4l or what.
 
-        #FIXME: updates and new messages are handled. Not the deletions.
-
-        if newMessage not in self.messages:
-            self.messages.append(deepcopy(newMessage))
+        message = self.messages.get(newMessage.uid)
+        if newMessage.addedBits & Message.DELETED:
+            if message is not None:
+                self.messages.remove(message)
+            return
+        if message is None:
+            self.messages.append(newMessage.copy())
             return
 
-        for message in self.messages:
-            if message.uid == newMessage.uid:
-                # Update message.
-                message.body = newMessage.body
-                message.flags = newMessage.flags
-                return
-
-        assert("should never hit this point")
+        # Update message.
+        message.body = newMessage.body
+        message.flagBits = newMessage.flagBits
 
 
 class StateDriver(Storage):
@@ -131,6 +377,47 @@ class StateDriver(Storage):
         super(StateDriver, self).update(message)
 
 
+class StateView(object):
+    """Read-only view over our state and their state.
+
+    Answer the last known message for a UID from both states, our state
+    first. Neither state is copied nor modified."""
+
+    def __init__(self, ourState, theirState):
+        self.ourState = ourState
+        self.theirState = theirState
+
+    def __contains__(self, message):
+        return (message in self.ourState.messages or
+            message in self.theirState.messages)
+
+    def get(self, uid, default=None):
+        """Return the last known message with this UID."""
+
+        message = self.ourState.messages.get(uid)
+        if message is None:
+            return self.theirState.messages.get(uid, default)
+        return message
+
+    def join(self, messages):
+        """Walk UID-sorted messages and the last known messages in lockstep.
+
+        Yield (uid, message, stateMessage) tuples, see mergeJoin()."""
+
+        rows = mergeJoin(messages, self.ourState.searchSorted(),
+            self.theirState.searchSorted())
+        for uid, message, stateMessage, theirMessage in rows:
+            if stateMessage is None:
+                stateMessage = theirMessage
+            yield uid, message, stateMessage
+
+    def searchSorted(self):
+        """Iterate over the last known messages in UID order."""
+
+        for uid, _, message in self.join(()):
+            yield message
+
+
 #TODO: fake real drivers.
 #TODO: Assign UID when storage is IMAP.
 class Driver(Storage):
@@ -149,12 +436,15 @@ class StateController(object):
         - the engine;
         - our state backend (read-only);
         - their state backend.
+
+    Both states are read through a StateView.
     """
 
     def __init__(self, driver, ourState, theirState):
         self.driver = driver # The driver we own.
         self.state = ourState
         self.theirState = theirState
+        self.stateView = StateView(ourState, theirState)
 
     def update(self, theirMessages):
         """Update this side with the messages from the other side."""
@@ -172,38 +462,53 @@ class StateController(object):
     def getChanges(self):
         """Explore our messages. Only return changes since previous sync."""
 
-        changedMessages = Messages() # Collection of new, deleted and updated messages.
-        messages = self.driver.search() # Would be async.
-        stateMessages = self.state.search() # Would be async.
-
-        #TODO: we have to read both states to know what to sync. The current
-        # implementation is wrong.
-        for message in self.theirState.search():
-            if message not in stateMessages:
-                stateMessages.append(deepcopy(message))
-
-        for message in messages:
-            if message not in stateMessages:
+        # Collection of new, deleted and updated messages.
+        return Messages(self.iterChanges())
+
+    def unknownMessages(self):
+        """Iterate over our messages unknown to both states, or without UID,
+        in one pass."""
+
+        for message in self.driver.search():
+            if message.uid is None or message not in self.stateView:
+                yield message
+
+    def iterChanges(self):
+        """Yield the changes while walking our messages and the state view in
+        UID order in lockstep, see mergeJoin(). Only the current message of
+        each is held and only the changes are copied.
+
+        The messages without UID cannot be walked in UID order: they are
+        new unless identical to the last known message without UID."""
+
+        rows = self.stateView.join(
+            self.driver.searchSorted()) # Would be async.
+        for uid, message, stateMessage in rows:
+            if message is None:
+                if stateMessage is not None:
+                    deletedMessage = stateMessage.copy()
+                    deletedMessage.setDeleted()
+                    yield deletedMessage
+            elif stateMessage is None:
                 # Missing in the other side.
-                changedMessages.append(deepcopy(message))
-            else:
-                for stateMessage in stateMessages:
-                    if message.uid == stateMessage.uid:
-                        if not message.identical(stateMessage):
-                            changedMessages.append(deepcopy(message))
-                            break #There is no point of iterating further.
-
-        for stateMessage in stateMessages:
-            if stateMessage not in messages:
-                # TODO: mark message as destroyed from real repository.
-                changedMessages.append(deepcopy(message))
+                yield message.copy()
+            elif not message.identical(stateMessage):
+                yield message.copy()
 
-        return changedMessages
+        stateMessage = self.stateView.get(None)
+        for message in self.driver.searchWithoutUID():
+            if stateMessage is None or not message.identical(stateMessage):
+                yield message.copy()
 
 
 class Engine(object):
-    """The engine."""
-    def __init__(self, left, right):
+    """The engine.
+
+    Before looking for the changes, the messages unknown to the states are
+    paired by content with reconcile(), unless reconcile is False."""
+
+    def __init__(self, left, right, reconcile=True):
+        self.reconcileContent = reconcile
         leftState = StateDriver([]) # Would be an emitter.
         rightState = StateDriver([]) # Would be an emitter.
         # Add the state controller to the chain of controllers of the drivers.
@@ -219,7 +524,59 @@ class Engine(object):
         print("rght:       %s"% self.right.driver.messages)
         print("state rght: %s"% self.right.state.messages)
 
+    def reconcile(self):
+        """Pair the messages unknown to the states by content, like when both
+        sides are not empty at first sync. Both sides already hold the
+        paired messages: their common flags are recorded in the states so
+        that only the flags are synced, not the messages. The messages
+        without UID take the UID of their copy or a new one.
+
+        Return the number of messages paired."""
+
+        rightIndex = ContentIndex(self.right.unknownMessages())
+        drivers = (self.left.driver, self.right.driver)
+        assignments = {driver: [] for driver in drivers}
+        # Never reuse a UID, even one only left in the states.
+        storages = drivers + (self.left.state, self.right.state)
+        nextUID = 1 + max((uid for storage in storages
+            for uid in storage.messages.uids() if uid is not None), default=0)
+
+        paired = 0
+        unpaired = [] # Our new messages.
+        for message in self.left.unknownMessages():
+            theirMessage = rightIndex.pop(message)
+            if theirMessage is None:
+                unpaired.append(message)
+                continue
+            uid = message.uid if message.uid is not None else theirMessage.uid
+            if uid is None:
+                uid, nextUID = nextUID, nextUID + 1
+            for driver, ourMessage in zip(drivers, (message, theirMessage)):
+                if ourMessage.uid is None:
+                    assignments[driver].append((ourMessage, uid))
+            paired += 1
+            # The flags set on one side only are changes to sync.
+            stateMessage = Message(uid, message.body)
+            stateMessage.flagBits = message.flagBits & theirMessage.flagBits
+            self.left.state.update(stateMessage)
+            self.right.state.update(stateMessage)
+
+        for driver, messages in zip(drivers,
+                (unpaired, rightIndex.remaining())):
+            for message in messages:
+                if message.uid is None:
+                    assignments[driver].append((message, nextUID))
+                    nextUID += 1
+        for driver in drivers:
+            if assignments[driver]:
+                driver.assignUIDs(assignments[driver])
+        return paired
+
     def run(self):
+        if self.reconcileContent is True:
+            paired = self.reconcile()
+            if paired > 0:
+                print("## Reconciled %i messages by content."% paired)
         leftMessages = self.left.getChanges() # Would be async.
         rightMessages = self.right.getChanges() # Would be async.
 
@@ -240,16 +597,15 @@ if __name__ == '__main__':
 
     m2r = Message(2, "2 body")
     m2l = Message(2, "2 body") # Same as m2r.
-    #TODO: first sync when one side is not empty or identical.
-    # Supporting this feature is really challenging!
-    # m2l.markRead()              # Same as m2r but read.
+    # First sync while both sides are not empty: paired by content.
+    m2l.markRead()              # Same as m2r but read.
 
     m3r = Message(3, "3 body") # Not at left.
 
-    #TODO: None UID is meant for new messages in Maildir.
-    # m4l = Message(None, "4 body") # Not at right.
+    # None UID is meant for new messages in Maildir.
+    m4l = Message(None, "4 body") # Not at right.
 
-    leftMessages = Messages([m1l, m2l])
+    leftMessages = Messages([m1l, m2l, m4l])
     rghtMessages = Messages([m1r, m2r, m3r])
 
     # Fill both sides with pre-existing data.